@@ -0,0 +1,76 @@
+"""
+Benchmark for the memory usage of the GTFS entity classes.
+
+Loads a GTFS file with GTFS.load_all(), builds route stories from the loaded stop times, and reports the number of
+objects and the average number of bytes per object of each entity class, and the RSS of the process.
+
+    python -m gtfs.benchmarks.memory_usage --gtfs_file_name data/sample/israel-public-transportation.zip
+"""
+import os
+import resource
+import sys
+from argparse import ArgumentParser
+
+from gtfs.parser.gtfs_reader import GTFS
+from gtfs.parser.route_stories import build_route_stories
+
+
+def object_size(obj):
+    """Returns the size of the object itself and its __dict__ (if it has one), not including the attribute values"""
+    size = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__)
+    return size
+
+
+def current_rss():
+    """Returns the resident set size of this process in bytes (Linux only)"""
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def peak_rss():
+    """Returns the peak resident set size of this process in bytes"""
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on Mac
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+def entities(g, route_stories):
+    """Yields (entity_name, list of objects) tuples for all the entity types"""
+    yield 'Agency', list(g.agencies.values())
+    yield 'Route', list(g.routes.values())
+    yield 'Trip', list(g.trips.values())
+    yield 'Service', list(g.services.values())
+    yield 'StopTime', [stop_time for trip in g.trips.values() if trip.stop_times is not None
+                       for stop_time in trip.stop_times]
+    yield 'Stop', list(g.stops.values())
+    yield 'Shape', list(g.shapes.values())
+    yield 'RouteStoryStop', [stop for route_story in route_stories.values() for stop in route_story.stops]
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--gtfs_file_name', default='data/sample/israel-public-transportation.zip')
+    args = parser.parse_args()
+
+    rss_before = current_rss()
+    g = GTFS(args.gtfs_file_name)
+    g.load_all()
+    rss_after_load = current_rss()
+    route_stories, _ = build_route_stories((trip.trip_id, trip.stop_times) for trip in g.trips.values()
+                                           if trip.stop_times is not None)
+
+    print()
+    print("%-16s %10s %14s" % ('entity', 'objects', 'bytes/object'))
+    for name, objects in entities(g, route_stories):
+        average_size = sum(object_size(o) for o in objects) / len(objects) if len(objects) > 0 else 0
+        print("%-16s %10d %14.1f" % (name, len(objects), average_size))
+    print()
+    print("RSS before load_all:  %8.1f MB" % (rss_before / 2 ** 20))
+    print("RSS after load_all:   %8.1f MB" % (rss_after_load / 2 ** 20))
+    print("Peak RSS:             %8.1f MB" % (peak_rss() / 2 ** 20))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""
+Benchmark for building route stories.
+
+Compares build_route_stories, which deduplicates route stories by a fingerprint of their packed encoding, with the
+previous implementation, which used tuples of RouteStoryStop objects as dictionary keys. The stop times are read from
+the GTFS file once, and each implementation is timed, and then run again under tracemalloc to measure the peak memory
+it allocates.
+
+    python -m gtfs.benchmarks.route_stories --gtfs_file_name data/sample/israel-public-transportation.zip
+
+The sample feed has only a few route stories, and its timings are too small to compare the implementations; use a full
+feed for that.
+"""
+import logging
+import time
+import tracemalloc
+from argparse import ArgumentParser
+
+from gtfs.parser import feed_cache
+from gtfs.parser.route_stories import RouteStory, RouteStoryStop, build_route_stories, group_by_trip_id, \
+    stop_times_file_generator
+
+
+def tuple_build_route_stories(trip_and_stop_times):
+    """The tuple based build_route_stories, kept for comparison"""
+    route_story_to_id = {}
+    trip_to_route_story = {}
+    for trip_id, stop_times in trip_and_stop_times:
+        start_time = stop_times[0].arrival_time
+        route_story_tuple = tuple(RouteStoryStop(stop_time.arrival_time - start_time,
+                                                 stop_time.departure_time - start_time,
+                                                 stop_time.stop_id,
+                                                 stop_time.stop_sequence,
+                                                 stop_time.pickup_type,
+                                                 stop_time.drop_off_type) for stop_time in stop_times)
+        if route_story_tuple not in route_story_to_id:
+            route_story_to_id[route_story_tuple] = len(route_story_to_id) + 1
+        trip_to_route_story[trip_id] = (route_story_to_id[route_story_tuple], start_time)
+
+    route_stories = {route_story_id: RouteStory(route_story_id, route_story_tuple)
+                     for route_story_tuple, route_story_id in route_story_to_id.items()}
+    return route_stories, trip_to_route_story
+
+
+def measure(build, trips):
+    """Returns the result of build(trips), the time it took in seconds, and the peak memory it allocated in bytes"""
+    start = time.perf_counter()
+    result = build(trips)
+    elapsed = time.perf_counter() - start
+    del result
+    tracemalloc.start()
+    result = build(trips)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--gtfs_file_name', default='data/sample/israel-public-transportation.zip')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    stop_times_file = feed_cache.extract_member(args.gtfs_file_name, 'stop_times.txt')
+    print("Reading %s" % stop_times_file)
+    trips = list(group_by_trip_id(stop_times_file_generator(stop_times_file)))
+    print("%d trips read" % len(trips))
+
+    results = []
+    print()
+    print("%-12s %12s %10s %16s" % ('build', 'stories', 'seconds', 'peak alloc (MB)'))
+    for name, build in [('tuples', tuple_build_route_stories), ('fingerprint', build_route_stories)]:
+        result, elapsed, peak = measure(build, trips)
+        results.append(result)
+        print("%-12s %12d %10.2f %16.1f" % (name, len(result[0]), elapsed, peak / 2 ** 20))
+
+    (tuple_stories, tuple_trips), (stories, trip_to_route_story) = results
+    same = tuple_trips == trip_to_route_story and len(tuple_stories) == len(stories) and \
+        all(tuple_stories[route_story_id].stops == route_story.stops for route_story_id, route_story in stories.items())
+    print()
+    print("Results are %s" % ('identical' if same else 'DIFFERENT'))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,7 +2,8 @@ import argparse
 from datetime import datetime
 
 from gtfs.parser.gtfs_reader import GTFS
-from gtfs.parser.route_stories import load_route_stories_from_csv
+from gtfs.parser.route_stories import load_route_stories, load_stop_route_story_index
+from gtfs.parser.timetable import Timetable
 from gtfs.bus2train.walking_distance import load_walking_distance_table
 import os
 from collections import defaultdict
@@ -11,52 +12,62 @@ import csv
 """Script to export all trains and buses calling at train station, on a given date"""
 
 
-def trains_calling_at_stations(g, trip_to_route_story, on_date):
+def trains_calling_at_stations(g, timetable, on_date):
     """Returns a map from stop_id to list of trains calling there on given date"""
     print("Running trains_calling_at_stations")
+    train_trips = timetable.trip_mask(trip.trip_id for trip in g.trips.values() if trip.route.train_route)
+    events = timetable.day_events(on_date, train_trips)
+    trip_ids = timetable.calendar.trip_ids
     stop_to_calling_trains = defaultdict(lambda: [])
-    for trip in g.trips.values():
-        if trip.route.train_route and trip.active_on_date(on_date):
-            start_time, route_story = trip_to_route_story[trip.trip_id]
-            for route_story_stop in route_story.stops:
-                stop_code = g.stops[route_story_stop.stop_id].stop_code
-                stop_to_calling_trains[route_story_stop.stop_id].append((route_story_stop.stop_id,
-                                                                         stop_code,
-                                                                         trip.route.line_number,
-                                                                         trip.route.route_desc,
-                                                                         trip.route.route_long_name,
-                                                                         start_time + route_story_stop.arrival_offset,
-                                                                         start_time + route_story_stop.departure_offset,
-                                                                         route_story_stop.pickup_type,
-                                                                         route_story_stop.drop_off_type))
+    for trip_index, stop_id, arrival_time, departure_time, pickup_type, drop_off_type in \
+            zip(*(column.tolist() for column in (events.trip, events.stop_id, events.arrival_time,
+                                                 events.departure_time, events.pickup_type, events.drop_off_type))):
+        route = g.trips[trip_ids[trip_index]].route
+        stop_to_calling_trains[stop_id].append((stop_id,
+                                                g.stops[stop_id].stop_code,
+                                                route.line_number,
+                                                route.route_desc,
+                                                route.route_long_name,
+                                                arrival_time,
+                                                departure_time,
+                                                pickup_type,
+                                                drop_off_type))
     return stop_to_calling_trains
 
 
-def buses_calling_at_stations(g, trip_to_route_story, train_station_stops, on_date):
+def buses_calling_at_stations(g, trip_to_route_story, train_station_stops, on_date, stop_index):
     print("Running buses_calling_at_stations")
+    g.load_service_calendar()
+    # the positions of the train station stops in every route story calling at one
+    station_stop_sequences = defaultdict(lambda: [])
+    for stop_id, stop_station_record in train_station_stops.items():
+        if stop_station_record.straight_line_distance <= 300:
+            for call in stop_index.calls_at(stop_id):
+                station_stop_sequences[call.route_story_id].append(call.stop_sequence)
+    for stop_sequences in station_stop_sequences.values():
+        stop_sequences.sort()
     stop_to_calling_buses = defaultdict(lambda: [])
-    for trip in g.trips.values():
-        if trip.route.bus_route and trip.active_on_date(on_date):
+    for trip in (g.trips[trip_id] for trip_id in g.service_calendar.active_trip_ids(on_date)):
+        if trip.route.bus_route:
             start_time, route_story = trip_to_route_story[trip.trip_id]
-            for route_story_stop in route_story.stops:
-                if route_story_stop.stop_id in train_station_stops:
-                    stop_station_record = train_station_stops[route_story_stop.stop_id]
-                    if stop_station_record.straight_line_distance <= 300:
-                        train_station_id = stop_station_record.station_id
-                        stop_code = g.stops[route_story_stop.stop_id].stop_code
-                        stop_to_calling_buses[train_station_id].append((route_story_stop.stop_id,
-                                                                        stop_code,
-                                                                        trip.route.line_number,
-                                                                        trip.route.route_desc,
-                                                                        trip.route.route_long_name,
-                                                                        start_time + route_story_stop.arrival_offset,
-                                                                        start_time + route_story_stop.departure_offset,
-                                                                        route_story_stop.pickup_type,
-                                                                        route_story_stop.drop_off_type,
-                                                                        stop_station_record.straight_line_distance,
-                                                                        stop_station_record.google_distance,
-                                                                        stop_station_record.gh_distance
-                                                                        ))
+            for stop_sequence in station_stop_sequences.get(route_story.route_story_id, []):
+                route_story_stop = route_story.stops[stop_sequence - 1]
+                stop_station_record = train_station_stops[route_story_stop.stop_id]
+                train_station_id = stop_station_record.station_id
+                stop_code = g.stops[route_story_stop.stop_id].stop_code
+                stop_to_calling_buses[train_station_id].append((route_story_stop.stop_id,
+                                                                stop_code,
+                                                                trip.route.line_number,
+                                                                trip.route.route_desc,
+                                                                trip.route.route_long_name,
+                                                                start_time + route_story_stop.arrival_offset,
+                                                                start_time + route_story_stop.departure_offset,
+                                                                route_story_stop.pickup_type,
+                                                                route_story_stop.drop_off_type,
+                                                                stop_station_record.straight_line_distance,
+                                                                stop_station_record.google_distance,
+                                                                stop_station_record.gh_distance
+                                                                ))
     return stop_to_calling_buses
 
 
@@ -73,12 +84,14 @@ def export_calling_at_station(gtfs, stop_to_calling_trains, output_folder):
                 writer.writerow(record)
 
 
-def main(gtfs_folder, walking_distance_file, output_folder, on_date):
-    gtfs = GTFS(os.path.join(gtfs_folder, 'israel-public-transportation.zip'))
+def main(gtfs_folder, walking_distance_file, output_folder, on_date, snapshot=False):
+    gtfs = GTFS(os.path.join(gtfs_folder, 'israel-public-transportation.zip'), snapshot=snapshot)
     gtfs.load_trips()
     gtfs.load_stops()
-    _, trip_to_route_story = load_route_stories_from_csv(os.path.join(gtfs_folder, 'route_stories.txt'),
-                                                         os.path.join(gtfs_folder, 'trip_to_stories.txt'))
+    route_stories, trip_to_route_story = load_route_stories(gtfs_folder)
+    stop_index = load_stop_route_story_index(gtfs_folder, route_stories)
+    gtfs.load_service_calendar()
+    timetable = Timetable(gtfs.service_calendar, route_stories, trip_to_route_story)
     station_stops = load_walking_distance_table(walking_distance_file)
 
     if not os.path.exists(output_folder):
@@ -114,14 +127,14 @@ def main(gtfs_folder, walking_distance_file, output_folder, on_date):
     if not os.path.exists(trains_folder):
         os.makedirs(trains_folder)
 
-    stop_to_calling_trains = trains_calling_at_stations(gtfs, trip_to_route_story, on_date)
+    stop_to_calling_trains = trains_calling_at_stations(gtfs, timetable, on_date)
     export_calling_at_station(gtfs, stop_to_calling_trains, trains_folder)
 
     buses_folder = os.path.join(output_folder, 'buses')
     if not os.path.exists(buses_folder):
         os.makedirs(buses_folder)
 
-    export_calling_at_station(gtfs, buses_calling_at_stations(gtfs, trip_to_route_story, station_stops, on_date),
+    export_calling_at_station(gtfs, buses_calling_at_stations(gtfs, trip_to_route_story, station_stops, on_date, stop_index),
                               buses_folder)
 
 
@@ -139,6 +152,8 @@ if __name__ == '__main__':
     parser.add_argument('--output_folder', required=True)
     parser.add_argument('-d', '--on_date', help='format YYYY-MM-DD', required=True, type=valid_date)
     parser.add_argument('--walking_distance_file', required=True)
+    parser.add_argument('--snapshot', action='store_true',
+                        help='keep a binary snapshot of the parsed gtfs next to the zip file, for faster loading')
     args = parser.parse_args()
     main(gtfs_folder=args.gtfs_folder, walking_distance_file=args.walking_distance_file,
-         output_folder=args.output_folder, on_date=args.on_date)
+         output_folder=args.output_folder, on_date=args.on_date, snapshot=args.snapshot)
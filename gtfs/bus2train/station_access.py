@@ -58,7 +58,8 @@ class StationAccessFinder:
 
     __4__: calculate route story frequencies
 
-    done by iterating over trips, similar to current ```route_frequency``` function.
+    for each route story, the number of times its trips run between start_date and end_date (inclusive), from the
+    service calendar: a trip counts once for every day it actually runs, not for every day of the range.
 
     Result: dictionary route_story_id -> (weekday_frequency, weekend_frequency)
 
@@ -128,9 +129,9 @@ class StationAccessFinder:
             self.travel_time = 0
 
     def __init__(self, gtfs_folder, output_folder, start_date, end_date=None, station_stop_distance=300,
-                 to_station=True):
+                 to_station=True, snapshot=False):
         print("StationAccessFinder.__init__")
-        self.gtfs = GTFS(os.path.join(gtfs_folder, 'israel-public-transportation.zip'))
+        self.gtfs = GTFS(os.path.join(gtfs_folder, 'israel-public-transportation.zip'), snapshot=snapshot)
         self.gtfs_folder = gtfs_folder
         self.output_folder = output_folder
         if not os.path.exists(self.output_folder):
@@ -138,10 +139,9 @@ class StationAccessFinder:
         self.to_station = to_station
         # load route stories
         print("Loading route stories")
-        self.route_stories, self.trips_to_route_stories = route_stories.load_route_stories_from_csv(
-            os.path.join(gtfs_folder, 'route_stories.txt'),
-            os.path.join(gtfs_folder, 'trip_to_stories.txt'))
+        self.route_stories, self.trips_to_route_stories = route_stories.load_route_stories(gtfs_folder)
         print("   There are %d route stories" % len(self.route_stories))
+        self.stop_index = route_stories.load_stop_route_story_index(gtfs_folder, self.route_stories)
         # configuration
         self.station_stop_distance = station_stop_distance
         self.start_date = start_date
@@ -180,10 +180,16 @@ class StationAccessFinder:
             f.write("Execution parameters:\n")
             f.write("  gtfs_folder: %s\n" % self.gtfs_folder)
             f.write("  start_date: %s\n" % self.start_date)
+            f.write("  end_date: %s\n" % self.end_date)
             f.write(
                 "  bus stop is considered to be serving a train station if it's up to %dm from it (straight line)" %
                 self.station_stop_distance)
             f.write('\n\n')
+            f.write("Fields of station_access.txt:\n")
+            f.write("  weekday_trips, weekend_trips - number of trips of the routes calling at the stop, between "
+                    "start_date and end_date (inclusive). A trip is counted once for every day it runs, by the "
+                    "service calendar, so a trip that runs 3 days of the range counts 3\n")
+            f.write('\n')
             f.write("Results:\n")
             f.write("  number of bus stops near stations: %d\n" % len(self.stops_near_stations))
             f.write("  number of bus routes calling at stations: %d\n" % len(self.extended_routes))
@@ -201,10 +207,12 @@ class StationAccessFinder:
 
     def route_story_train_station_stops(self):
         print("Running stage 2: route_story_train_station_stops")
-        # route story and all the stops near train stations
+        # route story and all the stops near train stations, only for route stories calling at these stops
+        route_story_ids = self.stop_index.route_story_ids_at(self.stops_near_stations)
         route_story_and_stations = ((route_story,
                                      [stop for stop in route_story.stops if stop.stop_id in self.stops_near_stations])
-                                    for route_story in self.route_stories.values())
+                                    for route_story in (self.route_stories[route_story_id]
+                                                        for route_story_id in sorted(route_story_ids)))
         # filter only route stories calling at a train station, and create an ExtendedRouteStory object
         extended_route_stories = (self.ExtendedRouteStory(route_story, stops) for (route_story, stops) in
                                   route_story_and_stations if len(stops) > 0)
@@ -241,18 +249,19 @@ class StationAccessFinder:
 
     def route_story_frequency(self):
         print("Running stage 4: route_story_frequency")
-        self.gtfs.load_trips()
-        trips = (trip for trip in self.gtfs.trips.values() if
-                 trip.service.end_date >= self.start_date or trip.service.start_date <= self.end_date)
-        for trip in trips:
-            route_story_id = self.trips_to_route_stories[trip.trip_id].route_story.route_story_id
+        self.gtfs.load_service_calendar()
+        calendar = self.gtfs.service_calendar
+        # number of days each trip runs in the date range
+        weekday_runs = calendar.trip_run_counts(self.start_date, self.end_date, weekdays)
+        all_runs = calendar.trip_run_counts(self.start_date, self.end_date)
+        for trip_id, trip_weekday_runs, trip_runs in zip(calendar.trip_ids, weekday_runs, all_runs):
+            if trip_runs == 0:
+                continue
+            route_story_id = self.trips_to_route_stories[trip_id].route_story.route_story_id
             if route_story_id in self.extended_route_stories:
                 extended_route_story = self.extended_route_stories[route_story_id]
-                for d in self.date_range():
-                    if d.weekday() in weekdays:
-                        extended_route_story.weekday_trips += 1
-                    else:
-                        extended_route_story.weekend_trips += 1
+                extended_route_story.weekday_trips += int(trip_weekday_runs)
+                extended_route_story.weekend_trips += int(trip_runs - trip_weekday_runs)
 
     def route_story_to_route(self):
         print("Running stage 5: route_story_to_route")
@@ -320,12 +329,6 @@ class StationAccessFinder:
                     'parent_stop': self.gtfs.stops[stop_and_station.stop_id].parent_station
                 })
 
-    def date_range(self):
-        d = self.start_date
-        while d <= self.end_date:
-            yield d
-            d += datetime.timedelta(days=1)
-
 
 def filter_station_access_results(folder, output_filename=None,
                                   max_time_difference_from_station=-1, stations_to_include=None,
@@ -0,0 +1,50 @@
+"""
+Sorting text files that don't fit in memory.
+
+The lines are read in chunks of up to max_lines_in_memory lines. Each chunk is sorted in memory and written to a
+temporary file, and the sorted chunks are then merged lazily with heapq.merge.
+"""
+import heapq
+import itertools
+import logging
+import tempfile
+
+
+def external_sort(lines, key, max_lines_in_memory=1000000):
+    """
+    Yields the lines of the iterable sorted by key, holding at most max_lines_in_memory lines in memory. If
+    max_lines_in_memory is None, all the lines are sorted in memory. Raises ValueError if max_lines_in_memory is less
+    than 1.
+    """
+    if max_lines_in_memory is not None and max_lines_in_memory < 1:
+        raise ValueError("max_lines_in_memory must be at least 1, got %s" % max_lines_in_memory)
+    return sorted_lines(iter(lines), key, max_lines_in_memory)
+
+
+def sorted_lines(lines, key, max_lines_in_memory):
+    """The generator of external_sort, which checks its arguments before the first line is read"""
+    chunk = sorted(itertools.islice(lines, max_lines_in_memory), key=key)
+    if max_lines_in_memory is None or len(chunk) < max_lines_in_memory:
+        # everything fits in memory, no need for temporary files
+        yield from chunk
+        return
+
+    chunk_files = []
+    try:
+        while len(chunk) > 0:
+            chunk_files.append(write_chunk(chunk))
+            chunk = sorted(itertools.islice(lines, max_lines_in_memory), key=key)
+        logging.debug("Merging %d sorted chunks" % len(chunk_files))
+        yield from heapq.merge(*chunk_files, key=key)
+    finally:
+        for f in chunk_files:
+            f.close()
+
+
+def write_chunk(sorted_lines):
+    """Writes the lines to a temporary file. Returns the file object, positioned at the start of the file."""
+    f = tempfile.TemporaryFile('w+', encoding='utf8')
+    for line in sorted_lines:
+        f.write(line if line.endswith('\n') else line + '\n')
+    f.seek(0)
+    return f
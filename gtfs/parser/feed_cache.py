@@ -0,0 +1,97 @@
+"""
+Helpers for caching data derived from a GTFS zip file on disk, next to the zip file.
+
+Cache entries live in a folder called <zip file name>.cache. Every entry is a sub folder named after the entry, the
+content key of the zip file and the entry format version, e.g. snapshot-<key>-v1. When the zip file is replaced by a
+newer feed, or the format of an entry changes, the old entries are no longer found and are removed on the next write.
+"""
+import hashlib
+import os
+import pickle
+import shutil
+import zipfile
+
+
+def feed_key(filename):
+    """
+    Returns a key identifying the content of the GTFS zip file.
+
+    The key is computed from the zip directory (member names, sizes and CRC32 checksums), so it doesn't require
+    reading, let alone decompressing, the whole file.
+    """
+    sha = hashlib.sha1()
+    with zipfile.ZipFile(filename) as z:
+        for info in sorted(z.infolist(), key=lambda i: i.filename):
+            sha.update(('%s,%d,%d\n' % (info.filename, info.file_size, info.CRC)).encode('utf8'))
+    return sha.hexdigest()[:16]
+
+
+def cache_folder(filename):
+    return filename + '.cache'
+
+
+def entry_folder(filename, entry_name, version):
+    """Returns the folder of a cache entry of the GTFS zip file. The folder might not exist."""
+    return os.path.join(cache_folder(filename), '%s-%s-v%d' % (entry_name, feed_key(filename), version))
+
+
+def remove_stale_entries(filename, entry_name, version):
+    """Removes all the entries called entry_name, except the one matching the current zip file and version"""
+    folder = cache_folder(filename)
+    current = os.path.basename(entry_folder(filename, entry_name, version))
+    for name in os.listdir(folder):
+        if name.startswith(entry_name + '-') and name != current:
+            print("Removing stale cache entry %s" % name)
+            shutil.rmtree(os.path.join(folder, name), ignore_errors=True)
+
+
+def replace_entry(tmp_folder, folder):
+    """Moves a fully written entry from tmp_folder to its place, replacing an older copy if there's one"""
+    if os.path.exists(folder):
+        shutil.rmtree(folder)
+    os.rename(tmp_folder, folder)
+
+
+def dump_pickle(obj, f, external_objects):
+    """
+    Pickles obj to file object f. Objects in the external_objects dictionary (from name to object) are not pickled,
+    only a reference to them is, and the same dictionary has to be passed to load_pickle.
+    """
+    names = {id(o): name for name, o in external_objects.items() if o is not None}
+
+    class Pickler(pickle.Pickler):
+        def persistent_id(self, o):
+            return names.get(id(o))
+
+    Pickler(f, pickle.HIGHEST_PROTOCOL).dump(obj)
+
+
+def load_pickle(f, external_objects):
+    """Loads an object pickled with dump_pickle"""
+
+    class Unpickler(pickle.Unpickler):
+        def persistent_load(self, pid):
+            return external_objects[pid]
+
+    return Unpickler(f).load()
+
+
+EXTRACTED_FORMAT_VERSION = 1
+
+
+def extract_member(filename, member):
+    """
+    Returns the path of an uncompressed copy of a member of the GTFS zip file, in the cache folder. The member is
+    extracted on the first call.
+    """
+    folder = entry_folder(filename, 'extracted', EXTRACTED_FORMAT_VERSION)
+    path = os.path.join(folder, member)
+    if not os.path.exists(path):
+        print("Extracting %s to %s" % (member, folder))
+        os.makedirs(folder, exist_ok=True)
+        tmp_path = '%s.tmp%d' % (path, os.getpid())
+        with zipfile.ZipFile(filename) as z, z.open(member) as src, open(tmp_path, 'wb') as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+        os.replace(tmp_path, path)
+        remove_stale_entries(filename, 'extracted', EXTRACTED_FORMAT_VERSION)
+    return path
@@ -3,78 +3,261 @@ A module for reading data from a GTFS zip file to memory.
 """
 import zipfile
 import datetime
+import os
 import csv
 import io
+import concurrent.futures
+import functools
+import hashlib
+import itertools
+from array import array
 from typing import Dict, Optional
 
+from gtfs.parser import feed_cache
+from gtfs.parser.external_sort import external_sort
+from gtfs.parser.stop_times_index import StopTimesIndex
+
+try:
+    import numpy as np
+    from gtfs.parser.service_calendar import ServiceCalendar
+except ImportError:
+    print("Failed to import numpy, columnar stop times and the service calendar will fail")
+
+
+SNAPSHOT_FORMAT_VERSION = 4
+# mean earth radius in meters, the same as gtfs.bus2train.geo.R_EARTH
+EARTH_RADIUS = (6378137.0 + 6356752.3141) / 2.0
+
+
+class FeedFilter:
+    """
+    Filters applied while loading a GTFS file, so memory and time scale with the part of the feed you need. None means
+    no filtering.
+
+    Routes are filtered by agency_ids and route_types, services (calendar records) by the date window, keeping the
+    services active on any date between start_date and end_date. Trips are kept only if both their route and their
+    service are kept, and stop times and shapes are read only for the kept trips.
+
+    Stops are filtered by bbox, a (min_lat, min_lon, max_lat, max_lon) tuple.
+    """
+
+    def __init__(self, agency_ids=None, route_types=None, start_date=None, end_date=None, bbox=None):
+        self.agency_ids = set(agency_ids) if agency_ids is not None else None
+        self.route_types = set(route_types) if route_types is not None else None
+        self.start_date = start_date
+        self.end_date = end_date
+        self.bbox = bbox
+
+    def __repr__(self):
+        return "<FeedFilter agency_ids=%s route_types=%s start_date=%s end_date=%s bbox=%s>" % (
+            sorted(self.agency_ids) if self.agency_ids is not None else None,
+            sorted(self.route_types) if self.route_types is not None else None,
+            self.start_date, self.end_date, self.bbox)
+
+    def key(self):
+        """A short string identifying the filter, e.g. for cache file names"""
+        return hashlib.sha1(repr(self).encode('utf8')).hexdigest()[:8]
+
+    def filters_trips(self):
+        return any(value is not None for value in (self.agency_ids, self.route_types, self.start_date, self.end_date))
+
+    def filters_anything(self):
+        return self.filters_trips() or self.bbox is not None
+
+    def route_matches(self, agency_id, route_type):
+        return ((self.agency_ids is None or agency_id in self.agency_ids) and
+                (self.route_types is None or route_type in self.route_types))
+
+    def service_matches(self, start_date, end_date):
+        return ((self.start_date is None or end_date >= self.start_date) and
+                (self.end_date is None or start_date <= self.end_date))
+
+    def stop_matches(self, lat, lon):
+        if self.bbox is None:
+            return True
+        min_lat, min_lon, max_lat, max_lon = self.bbox
+        return min_lat <= lat <= max_lat and min_lon <= lon <= max_lon
+
+
+def snapshotted(load_method):
+    """
+    Decorator for the GTFS load functions. If the GTFS object uses a snapshot, the tables are restored from it before
+    loading, and the snapshot is rewritten if the load function had to parse new tables.
+    """
+    @functools.wraps(load_method)
+    def wrapper(self, *args, **kwargs):
+        if not self.use_snapshot:
+            return load_method(self, *args, **kwargs)
+        if not self.snapshot_restored:
+            self.restore_snapshot()
+        self.loading_depth += 1
+        try:
+            load_method(self, *args, **kwargs)
+        finally:
+            self.loading_depth -= 1
+        if self.loading_depth == 0 and self.loaded_tables() != self.snapshot_tables:
+            self.save_snapshot()
+
+    return wrapper
+
 
 class GTFS:
     """
     A class that can read GTFS and contains all the GTFS data structures. Initialized with the GTFS zip file name.
     Creating the class doesn't load anything. Use load_all() to load all the data structures, or load just what you need
     using the individual load() functions
+
+    With snapshot=True, the parsed tables are also saved in a binary snapshot next to the zip file (see feed_cache), and
+    later GTFS objects for the same file restore them from there instead of parsing the csv files again.
+
+    If you only need part of the feed, pass a FeedFilter, and records that don't match it are dropped while loading.
     """
+    tables = ('agencies', 'routes', 'shapes', 'services', 'trips', 'stops')
 
-    def __init__(self, filename):
+    def __init__(self, filename, snapshot=False, feed_filter=None):
         self.filename = filename
+        self.feed_filter = feed_filter if feed_filter is not None else FeedFilter()
         self.agencies = None  # type: Optional[Dict[int, Agency]]
         self.routes = None  # type: Optional[Dict[int, Route]]
         self.shapes = None  # type: Optional[Dict[int, Shape]]
         self.services = None  # type: Optional[Dict[int, Service]]
         self.trips = None  # type: Optional[Dict[int, Trip]]
         self.stops = None  # type: Optional[Dict[int, Stop]]
+        self.stop_times = None  # type: Optional[StopTimesStore]
         self.stop_times_loaded = False
+        self.service_calendar = None  # type: Optional[ServiceCalendar]
+        self.stop_times_index = None  # type: Optional[StopTimesIndex]
+        self.use_snapshot = snapshot
+        self.snapshot_restored = False
+        self.snapshot_tables = set()
+        self.loading_depth = 0
+
+    def loaded_tables(self):
+        tables = {table for table in self.tables if getattr(self, table) is not None}
+        if self.stop_times_loaded:
+            tables.add('stop_times')
+        if self.stop_times is not None:
+            tables.add('stop_times_store')
+        return tables
+
+    def snapshot_name(self):
+        # snapshots of filtered feeds are kept separately for each filter
+        return 'snapshot_' + self.feed_filter.key() if self.feed_filter.filters_anything() else 'snapshot'
+
+    def snapshot_folder(self):
+        return feed_cache.entry_folder(self.filename, self.snapshot_name(), SNAPSHOT_FORMAT_VERSION)
+
+    def restore_snapshot(self):
+        """Restores the tables saved in the snapshot of the zip file, if there's one"""
+        self.snapshot_restored = True
+        folder = self.snapshot_folder()
+        if not os.path.exists(folder):
+            return
+        print("Restoring GTFS snapshot from %s" % folder)
+        stop_times_folder = os.path.join(folder, 'stop_times')
+        stop_times = StopTimesStore.load(stop_times_folder) if os.path.exists(stop_times_folder) else None
+        with open(os.path.join(folder, 'tables.pickle'), 'rb') as f:
+            tables, self.stop_times_loaded = feed_cache.load_pickle(f, {'stop_times': stop_times})
+        for table, value in tables.items():
+            setattr(self, table, value)
+        self.stop_times = stop_times
+        self.snapshot_tables = self.loaded_tables()
+
+    def save_snapshot(self):
+        """Saves all the loaded tables to the snapshot of the zip file"""
+        folder = self.snapshot_folder()
+        print("Saving GTFS snapshot to %s" % folder)
+        tmp_folder = '%s.tmp%d' % (folder, os.getpid())
+        os.makedirs(tmp_folder)
+        if self.stop_times is not None:
+            self.stop_times.save(os.path.join(tmp_folder, 'stop_times'))
+        with open(os.path.join(tmp_folder, 'tables.pickle'), 'wb') as f:
+            tables = {table: getattr(self, table) for table in self.tables if getattr(self, table) is not None}
+            feed_cache.dump_pickle((tables, self.stop_times_loaded), f, {'stop_times': self.stop_times})
+        feed_cache.replace_entry(tmp_folder, folder)
+        feed_cache.remove_stale_entries(self.filename, self.snapshot_name(), SNAPSHOT_FORMAT_VERSION)
+        self.snapshot_tables = self.loaded_tables()
+
+    @snapshotted
+    def load_all(self, columnar=False, parallel=False, processes=None):
+        """
+        Loads all the tables. With parallel=True the big tables (shapes, stops and stop_times) are parsed concurrently
+        in a pool of processes, while the small ones are loaded in this process. stop_times.txt itself is split to
+        chunks that are parsed concurrently, see submit_stop_times_chunks().
+        """
+        if parallel:
+            if self.feed_filter.filters_trips():
+                # the filtered trips are needed to know which shapes and stop times to read
+                self.load_trips()
+            with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+                shapes = executor.submit(read_shapes, self.filename, self.shape_id_filter()) \
+                    if self.shapes is None else None
+                stops = executor.submit(read_stops, self.filename, self.feed_filter) if self.stops is None else None
+                stop_times = submit_stop_times_chunks(self.filename, executor, processes, self.trip_id_filter()) \
+                    if not self.stop_times_loaded else None
+                self.load_trips()
+                if shapes is not None:
+                    self.shapes = shapes.result()
+                if stops is not None:
+                    self.stops = stops.result()
+                if stop_times is not None:
+                    self.set_stop_times(StopTimesStore.merge([f.result() for f in stop_times]), columnar)
 
-    def load_all(self):
         self.load_routes()
         self.load_shapes()
         self.load_trips()
         self.load_stops()
-        self.load_stop_times()
+        self.load_stop_times(columnar)
 
+    @snapshotted
     def load_agencies(self):
         if self.agencies is None:
             with zipfile.ZipFile(self.filename) as z:
                 print("Loading agencies")
-                with z.open('agency.txt') as f:
-                    reader = csv.DictReader(io.TextIOWrapper(f, 'utf8'))
-                    self.agencies = {agency.agency_id: agency for agency in
-                                     (Agency.from_csv(record) for record in reader)}
+                rows = read_table(z, 'agency.txt', ['agency_id', 'agency_name'], [int, None])
+                self.agencies = {agency.agency_id: agency for agency in (Agency(*row) for row in rows)}
                 print("%d agencies loaded" % len(self.agencies))
 
+    @snapshotted
     def load_routes(self):
         self.load_agencies()
 
         if self.routes is None:
             with zipfile.ZipFile(self.filename) as z:
                 print("Loading routes")
-                with z.open('routes.txt') as f:
-                    reader = csv.DictReader(io.TextIOWrapper(f, 'utf8'))
-                    self.routes = {route.route_id: route for route in (Route.from_csv(record, self.agencies)
-                                                                       for record in reader)}
+                rows = read_table(z, 'routes.txt',
+                                  ['route_id', 'agency_id', 'route_short_name', 'route_long_name', 'route_desc',
+                                   'route_type'],
+                                  [int, int, None, None, None, int])
+                self.routes = {route_id: Route(route_id, self.agencies[agency_id], *fields)
+                               for (route_id, agency_id, *fields) in rows
+                               if self.feed_filter.route_matches(agency_id, fields[-1])}
                 print("%d routes loaded" % len(self.routes))
 
+    @snapshotted
     def load_shapes(self):
         if self.shapes is None:
-            self.shapes = {}
-            with zipfile.ZipFile(self.filename) as z:
-                print("Loading shapes")
-                with z.open('shapes.txt') as f:
-                    reader = csv.DictReader(io.TextIOWrapper(f, 'utf8'))
-                    for record in reader:
-                        Shape.from_csv(record, self.shapes)
-                print("%d shapes loaded" % len(self.shapes))
+            if self.feed_filter.filters_trips():
+                self.load_trips()
+            self.shapes = read_shapes(self.filename, self.shape_id_filter())
 
+    @snapshotted
     def load_services(self):
         if self.services is None:
             with zipfile.ZipFile(self.filename) as z:
                 print("Loading services")
-                with z.open('calendar.txt') as f:
-                    reader = csv.DictReader(io.TextIOWrapper(f, 'utf8'))
-                    self.services = {service.service_id: service for service in
-                                     (Service.from_csv(record) for record in reader)}
+                day_names = list(Service.weekday_names)
+                rows = read_table(z, 'calendar.txt', ['service_id'] + day_names + ['start_date', 'end_date'],
+                                  [int] + [None] * len(day_names) + [parse_date, parse_date])
+                self.services = {}
+                for service_id, *days, start_date, end_date in rows:
+                    if not self.feed_filter.service_matches(start_date, end_date):
+                        continue
+                    days = {Service.weekday_names[day] for (day, value) in zip(day_names, days) if value == '1'}
+                    self.services[service_id] = Service(service_id, days, start_date, end_date)
                 print("%d services loaded" % len(self.services))
 
+    @snapshotted
     def load_trips(self):
         self.load_services()
         self.load_routes()
@@ -82,23 +265,51 @@ class GTFS:
         if self.trips is None:
             with zipfile.ZipFile(self.filename) as z:
                 print("Loading trips")
-                with z.open('trips.txt') as f:
-                    reader = csv.DictReader(io.TextIOWrapper(f, 'utf8'))
-                    self.trips = {trip.trip_id: trip for trip in (Trip.from_csv(record,
-                                                                                self.routes,
-                                                                                self.services) for record in reader)}
+                rows = read_table(z, 'trips.txt', ['route_id', 'service_id', 'trip_id', 'direction_id', 'shape_id'],
+                                  [int, int, None, int, parse_shape_id])
+                self.trips = {trip_id: Trip(self.routes[route_id], self.services[service_id], trip_id, direction_id,
+                                            shape_id)
+                              for (route_id, service_id, trip_id, direction_id, shape_id) in rows
+                              if route_id in self.routes and service_id in self.services}
                 print("%d trips loaded" % len(self.trips))
 
+    def load_service_calendar(self):
+        """Builds self.service_calendar, an index of the trips active on each date. See ServiceCalendar."""
+        self.load_trips()
+        if self.service_calendar is None:
+            self.service_calendar = ServiceCalendar(self.services, self.trips)
+
+    @snapshotted
     def load_stops(self):
         if self.stops is None:
-            with zipfile.ZipFile(self.filename) as z:
-                print("Loading stops")
-                with z.open('stops.txt') as f:
-                    reader = csv.DictReader(io.TextIOWrapper(f, 'utf8'))
-                    self.stops = {stop.stop_id: stop for stop in (Stop.from_csv(record) for record in reader)}
-                print("%d stops loaded" % len(self.stops))
+            self.stops = read_stops(self.filename, self.feed_filter)
+
+    @snapshotted
+    def load_stop_times(self, columnar=False, processes=None):
+        """
+        Populates the stop_times field of the trip objects.
+
+        By default every trip gets a tuple of StopTime objects, which is very slow and memory hungry for the full
+        feed. With columnar=True the stop times are kept in a StopTimesStore (available as self.stop_times), and
+        every trip gets a StopTimesView into it, which still behaves like a sequence of StopTime objects.
+
+        If processes is given, stop_times.txt is extracted and parsed in parallel by that many processes.
+        """
+        if self.stop_times_loaded and columnar and self.stop_times is None:
+            # the stop times were loaded as tuples (possibly restored from the snapshot of such a load), so they are
+            # read again into a store
+            self.stop_times_loaded = False
+
+        if not self.stop_times_loaded and processes is not None:
+            self.load_trips()
+            with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+                self.set_stop_times(read_stop_times_store(self.filename, executor, processes, self.trip_id_filter()),
+                                    columnar)
+
+        if not self.stop_times_loaded and columnar:
+            self.load_trips()
+            self.set_stop_times(read_stop_times_store(self.filename, trip_ids=self.trip_id_filter()), columnar)
 
-    def load_stop_times(self):
         if not self.stop_times_loaded:
             self.load_trips()
             print("Loading stop times. This will be very slow.")
@@ -108,6 +319,8 @@ class GTFS:
                     print("  reading records from file")
                     records_by_trip_id = {}
                     for i, record in enumerate(csv.DictReader(io.TextIOWrapper(f, 'utf8'))):
+                        if record['trip_id'] not in self.trips:
+                            continue
                         records_by_trip_id.setdefault(record['trip_id'], []).append(StopTime.from_csv(record))
                         if i % 100000 == 0:
                             print(datetime.datetime.now())
@@ -129,18 +342,224 @@ class GTFS:
                             self.trips[trip_id].stop_times = stop_times
             self.stop_times_loaded = True
 
+    def iter_stop_times(self, presorted=False, max_records_in_memory=1000000):
+        """
+        Yields (trip, stop_times) tuples, where stop_times is a list of StopTime objects sorted by stop_sequence,
+        without loading the whole stop_times table to memory. Trips with a bad stop sequence are skipped.
+
+        With presorted=True the records of each trip are assumed to be consecutive in stop_times.txt, and only one trip
+        is kept in memory at a time; a ValueError is raised if that's not the case. Otherwise the file is sorted by
+        trip_id, with an external sort that keeps at most max_records_in_memory records in memory.
+        """
+        self.load_trips()
+        with zipfile.ZipFile(self.filename) as z:
+            with z.open('stop_times.txt') as f:
+                lines = io.TextIOWrapper(f, 'utf8')
+                header = next(csv.reader([next(lines)]))
+                trip_col = header.index('trip_id')
+                stop_sequence_col = header.index('stop_sequence')
+
+                def key(line):
+                    tokens = line.split(',')
+                    return tokens[trip_col], int(tokens[stop_sequence_col])
+
+                if not presorted:
+                    lines = external_sort(lines, key, max_records_in_memory)
+                records = (dict(zip(header, row)) for row in csv.reader(lines))
+                seen_trip_ids = set()
+                for trip_id, trip_records in itertools.groupby(records, key=lambda record: record['trip_id']):
+                    if trip_id in seen_trip_ids:
+                        raise ValueError("Records of trip %s are not consecutive in stop_times.txt. "
+                                         "Use presorted=False." % trip_id)
+                    seen_trip_ids.add(trip_id)
+                    if trip_id not in self.trips:
+                        continue
+                    stop_times = sorted((StopTime.from_csv(record) for record in trip_records),
+                                        key=lambda stop_time: stop_time.stop_sequence)
+                    if stop_times[0].stop_sequence != 1 or stop_times[-1].stop_sequence != len(stop_times):
+                        print("Bad stop time sequence %s" % stop_times)
+                        continue
+                    yield self.trips[trip_id], stop_times
+
+    def stop_times_for(self, trip_id):
+        """
+        Returns a list of the StopTime objects of a single trip, sorted by stop_sequence, or an empty list if the trip
+        has no stop times. Only the records of the trip are read, using a StopTimesIndex that is built (once per feed)
+        on the first call.
+        """
+        if self.stop_times_index is None:
+            self.stop_times_index = StopTimesIndex.for_feed(self.filename)
+        return sorted((StopTime.from_csv(record) for record in self.stop_times_index.records(trip_id)),
+                      key=lambda stop_time: stop_time.stop_sequence)
+
+    def trip_id_filter(self):
+        """Returns the set of loaded trip ids if the feed filter drops trips, None otherwise"""
+        return set(self.trips) if self.feed_filter.filters_trips() else None
+
+    def shape_id_filter(self):
+        """Returns the set of shape ids of the loaded trips if the feed filter drops trips, None otherwise"""
+        return {trip.shape_id for trip in self.trips.values()} if self.feed_filter.filters_trips() else None
+
+    def set_stop_times(self, store, columnar):
+        """
+        Populates the stop_times field of the trip objects from a StopTimesStore. If columnar is False, the trips
+        get tuples of StopTime objects (like load_stop_times() does), and the store is discarded.
+        """
+        for trip_id, stop_times in store.trip_views():
+            if trip_id in self.trips:
+                self.trips[trip_id].stop_times = stop_times if columnar else tuple(stop_times)
+        self.stop_times = store if columnar else None
+        self.stop_times_loaded = True
+
+
+def read_table(z, member, columns, types, batch_size=100000):
+    """
+    Reads a csv file from an open zip file. Yields a tuple for each record, with the values of the given columns.
+
+    types is a list with a conversion function for each column (e.g. int), or None to keep the string value. The header
+    is resolved to column indexes once, and the values are converted column by column, in batches of records.
+    """
+    for values in read_table_batches(z, member, columns, types, batch_size):
+        yield from zip(*values)
+
+
+def read_table_batches(z, member, columns, types, batch_size=100000):
+    """Like read_table(), but yields the records in batches, each a list of converted values per column"""
+    with z.open(member) as f:
+        reader = csv.reader(io.TextIOWrapper(f, 'utf-8-sig'))
+        header = next(reader)
+        indexes = [header.index(column) for column in columns]
+        for batch in iter(lambda: list(itertools.islice(reader, batch_size)), []):
+            values = [[row[i] for row in batch] for i in indexes]
+            yield [list(map(convert, column)) if convert is not None else column
+                   for (convert, column) in zip(types, values)]
+
+
+def parse_date(value):
+    """Parses a YYYYMMDD date"""
+    return datetime.date(int(value[:4]), int(value[4:6]), int(value[6:]))
+
+
+def parse_shape_id(value):
+    return int(value) if value != '' else -1
+
+
+def read_shapes(filename, shape_ids=None):
+    """
+    Reads the shapes from the GTFS zip file. Returns a dictionary from shape_id to Shape object.
+    If shape_ids is given, only these shapes are read.
+    """
+    shape_id, lat, lon, sequence = array('i'), array('d'), array('d'), array('i')
+    with zipfile.ZipFile(filename) as z:
+        print("Loading shapes")
+        for values in read_table_batches(z, 'shapes.txt',
+                                         ['shape_id', 'shape_pt_lat', 'shape_pt_lon', 'shape_pt_sequence'],
+                                         [int, float, float, int]):
+            for column, column_values in zip((shape_id, lat, lon, sequence), values):
+                column.extend(column_values)
+    shape_id, sequence = np.frombuffer(shape_id, dtype=np.int32), np.frombuffer(sequence, dtype=np.int32)
+    lat, lon = np.frombuffer(lat, dtype=np.float64), np.frombuffer(lon, dtype=np.float64)
+    if shape_ids is not None:
+        keep = np.isin(shape_id, list(shape_ids))
+        shape_id, lat, lon, sequence = shape_id[keep], lat[keep], lon[keep], sequence[keep]
+    store = ShapeStore.from_columns(shape_id, sequence, lat, lon)
+    shapes = {shape.shape_id: shape for shape in store.shapes()}
+    print("%d shapes loaded" % len(shapes))
+    return shapes
+
+
+def read_stops(filename, feed_filter=None):
+    """
+    Reads the stops from the GTFS zip file. Returns a dictionary from stop_id to Stop object.
+    If feed_filter is given, only the stops matching it are read.
+    """
+    with zipfile.ZipFile(filename) as z:
+        print("Loading stops")
+        rows = read_table(z, 'stops.txt', ['stop_id'] + Stop.csv_fields, [int] + [None] * len(Stop.csv_fields))
+        lat_col, lon_col = Stop.csv_fields.index('stop_lat') + 1, Stop.csv_fields.index('stop_lon') + 1
+        stops = {row[0]: Stop(*row) for row in rows
+                 if feed_filter is None or feed_filter.stop_matches(float(row[lat_col]), float(row[lon_col]))}
+        print("%d stops loaded" % len(stops))
+    return stops
+
+
+def read_stop_times_store(filename, executor=None, chunks=None, trip_ids=None):
+    """
+    Reads the stop times from the GTFS zip file into a StopTimesStore. If trip_ids is given, only the stop times of
+    these trips are read.
+
+    If an executor (a concurrent.futures.ProcessPoolExecutor) is given, stop_times.txt is parsed in parallel by its
+    workers, in the given number of chunks, see submit_stop_times_chunks().
+    """
+    if executor is not None:
+        store = StopTimesStore.merge([f.result() for f in submit_stop_times_chunks(filename, executor, chunks,
+                                                                                   trip_ids)])
+    else:
+        with zipfile.ZipFile(filename) as z:
+            print("Loading stop times into columnar store")
+            with z.open('stop_times.txt') as f:
+                store = StopTimesStore.from_csv(io.TextIOWrapper(f, 'utf8'), trip_ids)
+    print("  %d records read for %d trips" % (len(store), len(store.trip_ids)))
+    return store
+
+
+def submit_stop_times_chunks(filename, executor, chunks=None, trip_ids=None):
+    """
+    Extracts stop_times.txt from the GTFS zip file to the cache folder (once), splits it to chunks on line boundaries,
+    and submits parsing the chunks to executor. Returns a list of futures, whose results can be passed to
+    StopTimesStore.merge().
+    """
+    path = feed_cache.extract_member(filename, 'stop_times.txt')
+    chunks = chunks or os.cpu_count()
+    print("Loading stop times in %d chunks" % chunks)
+    header, ranges = split_csv_file(path, chunks)
+    return [executor.submit(read_stop_times_chunk, path, header, start, end, trip_ids) for start, end in ranges]
+
+
+def split_csv_file(path, chunks):
+    """
+    Splits a csv file to byte ranges on line boundaries. Returns a tuple (header, ranges) where header is the list of
+    column names, and ranges is a list of (start, end) byte offsets, covering all the lines after the header.
+    """
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        header = next(csv.reader([f.readline().decode('utf-8-sig')]))
+        offsets = [f.tell()]
+        for i in range(1, chunks):
+            f.seek(max(offsets[-1], size * i // chunks))
+            f.readline()
+            offsets.append(min(f.tell(), size))
+        offsets.append(size)
+    ranges = [(start, end) for start, end in zip(offsets[:-1], offsets[1:]) if end > start]
+    return header, ranges
+
+
+def read_stop_times_chunk(path, header, start, end, trip_ids=None):
+    """Parses the stop_times records in the byte range [start, end) of the file. See StopTimesStore.parse_records()"""
+    with open(path, 'rb') as f:
+        f.seek(start)
+        lines = f.read(end - start).decode('utf8').splitlines()
+    return StopTimesStore.parse_records(csv.reader(lines), header, trip_ids)
+
+
+def parse_timestamp(timestamp):
+    """Returns second since start of day"""
+    # We need to manually parse because there's hours >= 24; but ain't Python doing it beautifully?
+    (hour, minute, second) = (int(f) for f in timestamp.split(':'))
+    return hour * 60 * 60 + minute * 60 + second
+
 
 class Agency:
+    __slots__ = ('agency_id', 'agency_name')
+
     def __init__(self, agency_id, agency_name):
         self.agency_id = agency_id
         self.agency_name = agency_name
 
-    @classmethod
-    def from_csv(cls, csv_record):
-        return cls(int(csv_record['agency_id']), csv_record['agency_name'])
-
 
 class Route:
+    __slots__ = ('route_id', 'agency', 'agency_id', 'line_number', 'route_long_name', 'route_desc', 'route_type')
+
     # line number if called "route short name" in the gtfs
     def __init__(self, route_id, agency, line_number, route_long_name, route_desc, route_type):
         self.route_id = route_id
@@ -169,16 +588,10 @@ class Route:
     def __hash__(self):
         return hash(self.route_id)
 
-    @classmethod
-    def from_csv(cls, csv_record, agencies):
-        agency_id = int(csv_record['agency_id'])
-        return cls(int(csv_record['route_id']),
-                   agencies[agency_id],
-                   csv_record['route_short_name'], csv_record['route_long_name'],
-                   csv_record['route_desc'], int(csv_record['route_type']))
-
 
 class Trip:
+    __slots__ = ('route', 'service', 'trip_id', 'direction_id', 'shape_id', 'stop_times_ids', 'stop_times')
+
     def __init__(self, route, service, trip_id, direction_id, shape_id):
         self.route = route
         self.service = service
@@ -191,19 +604,10 @@ class Trip:
     def active_on_date(self, on_date):
         return self.service.start_date <= on_date <= self.service.end_date and on_date.weekday() in self.service.days
 
-    @classmethod
-    def from_csv(cls, csv_record, routes, services):
-        route = routes[int(csv_record['route_id'])]
-        service = services[int(csv_record['service_id'])]
-        return cls(route,
-                   service,
-                   csv_record['trip_id'],
-                   int(csv_record['direction_id']),
-                   int(csv_record['shape_id']) if csv_record['shape_id'] != '' else -1)
-
 
 class Service:
     weekday_names = dict(zip('monday tuesday wednesday thursday friday saturday sunday'.split(), range(7)))
+    __slots__ = ('end_date', 'start_date', 'days', 'service_id')
 
     def __init__(self, service_id, days, start_date, end_date):
         self.end_date = end_date
@@ -217,17 +621,10 @@ class Service:
     def __hash__(self):
         return hash(self.service_id)
 
-    @classmethod
-    def from_csv(cls, csv_record):
-        service_id = int(csv_record['service_id'])
-        days = {Service.weekday_names[day] for day in Service.weekday_names.keys() if csv_record[day] == '1'}
-        start_date = datetime.datetime.strptime(csv_record['start_date'], "%Y%m%d").date()
-        end_date = datetime.datetime.strptime(csv_record['end_date'], "%Y%m%d").date()
-        return cls(service_id, days, start_date, end_date)
-
 
 class StopTime:
     keys = 'trip_id,arrival_time,departure_time,stop_id,stop_sequence,pickup_type,drop_off_type'.split(',')
+    __slots__ = ('drop_off_type', 'pickup_type', 'stop_sequence', 'stop_id', 'departure_time', 'arrival_time')
 
     def __init__(self, arrival_time, departure_time, stop_id, stop_sequence, pickup_type, drop_off_type):
         self.drop_off_type = drop_off_type
@@ -239,12 +636,6 @@ class StopTime:
 
     @classmethod
     def from_csv(cls, csv_record):
-        def parse_timestamp(timestamp):
-            """Returns second since start of day"""
-            # We need to manually parse because there's hours >= 24; but ain't Python doing it beautifully?
-            (hour, minute, second) = (int(f) for f in timestamp.split(':'))
-            return hour * 60 * 60 + minute * 60 + second
-
         arrival_time = parse_timestamp(csv_record['arrival_time'])
         departure_time = parse_timestamp(csv_record['departure_time'])
         stop_id = int(csv_record['stop_id'])
@@ -259,7 +650,214 @@ class StopTime:
         return StopTime.from_csv({key: token for (key, token) in zip (StopTime.keys, tokens)})
 
 
+class StopTimesStore:
+    """
+    Columnar storage for the stop_times table.
+
+    Every column is kept in a single int32 array (trip, stop_id, arrival_time, departure_time, stop_sequence,
+    pickup_type, drop_off_type), with the records sorted by trip and stop sequence. The records of the trip with
+    index i are offsets[i]:offsets[i + 1]; trip_ids[i] is its trip_id. Empty pickup_type and drop_off_type values are
+    stored as EMPTY_TYPE.
+    """
+    EMPTY_TYPE = -1
+
+    columns = 'trip,stop_id,arrival_time,departure_time,stop_sequence,pickup_type,drop_off_type'.split(',')
+
+    def __init__(self, trip_ids, offsets, trip, stop_id, arrival_time, departure_time, stop_sequence, pickup_type,
+                 drop_off_type):
+        """Use from_columns() or from_csv() to create a store from unsorted records"""
+        self.trip_ids = trip_ids
+        self.trip_index = {trip_id: i for i, trip_id in enumerate(trip_ids)}
+        self.offsets = offsets
+        self.trip = trip
+        self.stop_id = stop_id
+        self.arrival_time = arrival_time
+        self.departure_time = departure_time
+        self.stop_sequence = stop_sequence
+        self.pickup_type = pickup_type
+        self.drop_off_type = drop_off_type
+
+    @classmethod
+    def from_columns(cls, trip_ids, trip, *columns):
+        """Creates a store from unsorted column arrays; trip is an array of indexes into trip_ids"""
+        order = np.lexsort((columns[cls.columns.index('stop_sequence') - 1], trip))
+        offsets = np.zeros(len(trip_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(trip, minlength=len(trip_ids)), out=offsets[1:])
+        return cls(trip_ids, offsets, trip[order], *(column[order] for column in columns))
+
+    def save(self, folder):
+        """Saves the store to folder, one .npy file per array"""
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, 'trip_ids.txt'), 'w', encoding='utf8') as f:
+            f.write('\n'.join(self.trip_ids))
+        np.save(os.path.join(folder, 'offsets.npy'), self.offsets)
+        for column in self.columns:
+            np.save(os.path.join(folder, column + '.npy'), getattr(self, column))
+
+    @classmethod
+    def load(cls, folder):
+        """Loads a store written by save(). The arrays are memory-mapped, not read."""
+        with open(os.path.join(folder, 'trip_ids.txt'), encoding='utf8') as f:
+            content = f.read()
+        trip_ids = content.split('\n') if content != '' else []
+        return cls(trip_ids, *(np.load(os.path.join(folder, name + '.npy'), mmap_mode='r')
+                               for name in ['offsets'] + cls.columns))
+
+    def __len__(self):
+        return len(self.trip)
+
+    def valid_trips(self):
+        """Returns a boolean array, True for trips with stop sequence 1..n"""
+        counts = np.diff(self.offsets)
+        non_empty = counts > 0
+        first = np.where(non_empty, self.stop_sequence[np.minimum(self.offsets[:-1], len(self) - 1)], 0)
+        last = np.where(non_empty, self.stop_sequence[np.maximum(self.offsets[1:] - 1, 0)], 0)
+        return non_empty & (first == 1) & (last == counts)
+
+    def trip_views(self):
+        """Yields (trip_id, StopTimesView) for all the trips with a valid stop sequence"""
+        valid = self.valid_trips()
+        for i in np.flatnonzero(valid):
+            yield self.trip_ids[i], StopTimesView(self, self.offsets[i], self.offsets[i + 1])
+        bad_trips = len(self.trip_ids) - np.count_nonzero(valid)
+        if bad_trips > 0:
+            print("%d trips with bad stop time sequence skipped" % bad_trips)
+
+    def stop_times(self, trip_id):
+        """Returns a StopTimesView of the given trip"""
+        i = self.trip_index[trip_id]
+        return StopTimesView(self, self.offsets[i], self.offsets[i + 1])
+
+    @classmethod
+    def from_csv(cls, text_file, trip_ids=None):
+        reader = csv.reader(text_file)
+        header = next(reader)
+        return cls.merge([cls.parse_records(reader, header, trip_ids)])
+
+    @classmethod
+    def parse_records(cls, rows, header, trip_ids_filter=None):
+        """
+        Parses stop_times records (lists of strings, in the order given by header). Returns a tuple (trip_ids, columns):
+        trip_ids is a list of trip_id values, and columns is a list of arrays, one for each of StopTimesStore.columns,
+        where the trip column holds indexes into trip_ids. The result is picklable, and can be passed to merge().
+
+        If trip_ids_filter (a set of trip ids) is given, records of other trips are skipped.
+        """
+        (trip_col, arrival_col, departure_col, stop_id_col, stop_sequence_col, pickup_col, drop_off_col) = \
+            (header.index(key) for key in StopTime.keys)
+        if trip_ids_filter is not None:
+            rows = (row for row in rows if row[trip_col] in trip_ids_filter)
+
+        trip_ids = {}
+        # there are only 86400 seconds in a day (give or take), so the timestamps repeat a lot
+        timestamps = {}
+        trip, stop_id, arrival_time, departure_time, stop_sequence, pickup_type, drop_off_type = \
+            (array('i') for _ in cls.columns)
+        for row in rows:
+            trip.append(trip_ids.setdefault(row[trip_col], len(trip_ids)))
+            arrival = row[arrival_col]
+            if arrival not in timestamps:
+                timestamps[arrival] = parse_timestamp(arrival)
+            arrival_time.append(timestamps[arrival])
+            departure = row[departure_col]
+            if departure not in timestamps:
+                timestamps[departure] = parse_timestamp(departure)
+            departure_time.append(timestamps[departure])
+            stop_id.append(int(row[stop_id_col]))
+            stop_sequence.append(int(row[stop_sequence_col]))
+            pickup_type.append(int(row[pickup_col]) if row[pickup_col] != '' else cls.EMPTY_TYPE)
+            drop_off_type.append(int(row[drop_off_col]) if row[drop_off_col] != '' else cls.EMPTY_TYPE)
+
+        return list(trip_ids), [trip, stop_id, arrival_time, departure_time, stop_sequence, pickup_type, drop_off_type]
+
+    @classmethod
+    def merge(cls, parts):
+        """Creates a store from a list of (trip_ids, columns) tuples, as returned by parse_records()"""
+        trip_index = {}
+        merged_columns = [[] for _ in cls.columns]
+        for trip_ids, columns in parts:
+            # map the trip indexes of the part to indexes in the merged trip list
+            part_to_merged = np.array([trip_index.setdefault(trip_id, len(trip_index)) for trip_id in trip_ids],
+                                      dtype=np.int32)
+            columns = [np.frombuffer(column, dtype=np.int32) for column in columns]
+            columns[0] = part_to_merged[columns[0]]
+            for merged_column, column in zip(merged_columns, columns):
+                merged_column.append(column)
+        return cls.from_columns(list(trip_index), *(np.concatenate(column) if len(column) > 0
+                                                    else np.zeros(0, dtype=np.int32) for column in merged_columns))
+
+
+def type_string(value):
+    """Returns a stored pickup_type or drop_off_type as the csv value, '' for StopTimesStore.EMPTY_TYPE"""
+    return str(value) if value != StopTimesStore.EMPTY_TYPE else ''
+
+
+class StopTimesView:
+    """
+    The stop times of a single trip in a StopTimesStore.
+
+    The column properties are NumPy views into the store arrays, so creating a view is cheap. For compatibility,
+    indexing and iterating a view gives StopTime objects, the same as the tuple load_stop_times() used to build.
+    """
+    __slots__ = ('store', 'start', 'end')
+
+    def __init__(self, store, start, end):
+        self.store = store
+        self.start = start
+        self.end = end
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [self[i] for i in range(*item.indices(len(self)))]
+        if item < 0:
+            item += len(self)
+        if not 0 <= item < len(self):
+            raise IndexError("stop time index out of range")
+        i = self.start + item
+        s = self.store
+        return StopTime(int(s.arrival_time[i]), int(s.departure_time[i]), int(s.stop_id[i]),
+                        int(s.stop_sequence[i]), type_string(s.pickup_type[i]), type_string(s.drop_off_type[i]))
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def __repr__(self):
+        return "<StopTimesView of %d stop times>" % len(self)
+
+    @property
+    def stop_id(self):
+        return self.store.stop_id[self.start:self.end]
+
+    @property
+    def arrival_time(self):
+        return self.store.arrival_time[self.start:self.end]
+
+    @property
+    def departure_time(self):
+        return self.store.departure_time[self.start:self.end]
+
+    @property
+    def stop_sequence(self):
+        return self.store.stop_sequence[self.start:self.end]
+
+    @property
+    def pickup_type(self):
+        return self.store.pickup_type[self.start:self.end]
+
+    @property
+    def drop_off_type(self):
+        return self.store.drop_off_type[self.start:self.end]
+
+
 class Stop:
+    __slots__ = ('stop_id', 'stop_code', 'stop_name', 'stop_desc', 'stop_lat', 'stop_lon', 'location_type',
+                 'parent_station', 'zone_id')
+    # the fields of the stops file, other than stop_id, in the order of the constructor arguments
+    csv_fields = "stop_code,stop_name,stop_desc,stop_lat,stop_lon,location_type,parent_station,zone_id".split(',')
+
     def __init__(self, stop_id, stop_code, stop_name, stop_desc, stop_lat, stop_lon, location_type, parent_station,
                  zone_id):
         self.stop_id = stop_id
@@ -296,21 +894,67 @@ class Stop:
         return self.stop_desc.split(":")[4].strip()
 
 
+class ShapeStore:
+    """
+    Columnar storage for the shapes table.
+
+    The points of all the shapes are kept in contiguous arrays (lat, lon, sequence), sorted by shape and sequence.
+    The points of the shape with index i are offsets[i]:offsets[i + 1]; shape_ids[i] is its shape_id.
+    distance[j] is the distance in meters along the shape, from the first point of the shape to point j.
+    """
+
+    def __init__(self, shape_ids, offsets, sequence, lat, lon):
+        self.shape_ids = shape_ids
+        self.offsets = offsets
+        self.sequence = sequence
+        self.lat = lat
+        self.lon = lon
+        self.distance = self.cumulative_distance()
+
     @classmethod
-    def from_csv(cls, csv_record):
-        stop_id = int(csv_record['stop_id'])
-        field_names = "stop_code,stop_name,stop_desc,stop_lat,stop_lon,location_type,parent_station,zone_id".split(',')
-        fields = [csv_record[field] for field in field_names]
-        return cls(stop_id, *fields)
+    def from_columns(cls, shape_id, sequence, lat, lon):
+        """Creates a store from unsorted point columns"""
+        order = np.lexsort((sequence, shape_id))
+        shape_id = shape_id[order]
+        shape_ids, counts = np.unique(shape_id, return_counts=True)
+        offsets = np.zeros(len(shape_ids) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        return cls([int(i) for i in shape_ids], offsets, sequence[order], lat[order], lon[order])
+
+    def __len__(self):
+        return len(self.lat)
+
+    def cumulative_distance(self):
+        lat, lon = np.radians(self.lat), np.radians(self.lon)
+        # haversine distance between consecutive points
+        a = (np.sin(np.diff(lat) / 2) ** 2 +
+             np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(np.diff(lon) / 2) ** 2)
+        steps = np.zeros(len(self), dtype=np.float64)
+        steps[1:] = 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+        # no distance between the last point of a shape and the first point of the next one
+        steps[self.offsets[:-1]] = 0
+        distance = np.cumsum(steps)
+        return distance - np.repeat(distance[self.offsets[:-1]], np.diff(self.offsets))
+
+    def shapes(self):
+        """Returns a list of Shape objects, one for each shape in the store"""
+        return [Shape(shape_id, self, self.offsets[i], self.offsets[i + 1]) for i, shape_id in enumerate(self.shape_ids)]
 
 
 class Shape:
-    def __init__(self, shape_id):
+    """
+    A shape in a ShapeStore. The lat, lon, sequence and distance properties are NumPy views into the store arrays.
+    """
+    __slots__ = ('shape_id', 'store', 'start', 'end')
+
+    def __init__(self, shape_id, store, start, end):
         self.shape_id = shape_id
-        self.coordinates = {}
+        self.store = store
+        self.start = start
+        self.end = end
 
-    def add_coordinate(self, point, sequence):
-        self.coordinates[sequence] = point
+    def __len__(self):
+        return self.end - self.start
 
     def __eq__(self, other):
         return self.shape_id == other.shape_id
@@ -318,14 +962,36 @@ class Shape:
     def __hash__(self):
         return hash(self.shape_id)
 
-    # shape_id,shape_pt_lat,shape_pt_lon,shape_pt_sequence
-    @classmethod
-    def from_csv(cls, csv_record, current_shapes):
-        shape_id = int(csv_record['shape_id'])
-        point = (float(csv_record['shape_pt_lat']), float(csv_record['shape_pt_lon']))
-        sequence = int(csv_record['shape_pt_sequence'])
-        shape = current_shapes.setdefault(shape_id, Shape(shape_id))
-        shape.add_coordinate(point, sequence)
+    @property
+    def lat(self):
+        return self.store.lat[self.start:self.end]
+
+    @property
+    def lon(self):
+        return self.store.lon[self.start:self.end]
+
+    @property
+    def sequence(self):
+        return self.store.sequence[self.start:self.end]
+
+    @property
+    def distance(self):
+        """Distance in meters along the shape from its first point, for each point"""
+        return self.store.distance[self.start:self.end]
+
+    @property
+    def length(self):
+        return float(self.distance[-1]) if len(self) > 0 else 0.0
+
+    @property
+    def points(self):
+        """List of (lat, lon) tuples, sorted by sequence"""
+        return list(zip(self.lat.tolist(), self.lon.tolist()))
+
+    @property
+    def coordinates(self):
+        """Dictionary from sequence to (lat, lon) tuple, sorted by sequence"""
+        return dict(zip(self.sequence.tolist(), self.points))
 
 
 if __name__ == '__main__':
@@ -7,7 +7,7 @@ from collections import Counter
 from argparse import ArgumentParser
 import csv
 from gtfs.parser.gtfs_reader import GTFS
-from gtfs.parser.route_stories import load_route_stories_from_csv
+from gtfs.parser.route_stories import load_route_stories
 
 
 def choose_route_by_line_number(line_number, g):
@@ -92,14 +92,15 @@ def main():
     parser.add_argument('--gtfs_folder', required=True)
     parser.add_argument('--line_number', required=True, type=str)
     parser.add_argument('--output_file', required=True)
+    parser.add_argument('--snapshot', action='store_true',
+                        help='keep a binary snapshot of the parsed gtfs next to the zip file, for faster loading')
     args = parser.parse_args()
     print("Loading gtfs, please wait...")
-    g = GTFS(os.path.join(args.gtfs_folder, 'israel-public-transportation.zip'))
+    g = GTFS(os.path.join(args.gtfs_folder, 'israel-public-transportation.zip'), snapshot=args.snapshot)
     g.load_routes()
     g.load_trips()
     g.load_stops()
-    _, trip_to_route_story = load_route_stories_from_csv(os.path.join(args.gtfs_folder, 'route_stories.txt'),
-                                                         os.path.join(args.gtfs_folder, 'trip_to_stories.txt'))
+    _, trip_to_route_story = load_route_stories(args.gtfs_folder)
     route = choose_route_by_line_number(args.line_number, g)
     stops = route_stops(route, g, trip_to_route_story)
     export_stops(stops, args.output_file)
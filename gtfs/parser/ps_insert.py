@@ -1,11 +1,22 @@
 import os
+import io
+import re
 from jinja2 import Environment, FileSystemLoader
 import csv
 import sys
+import itertools
+import time
+import zipfile
+import contextlib
+import tempfile
+import concurrent.futures
 import psycopg2
 from configparser import ConfigParser
 import datetime
 
+from gtfs.parser.external_sort import external_sort
+from gtfs.parser.gtfs_reader import split_csv_file
+
 
 def parent_dir(p):
     return os.path.abspath(os.path.join(p, os.pardir))
@@ -71,19 +82,49 @@ def get_table_name(file_path):
     return "gtfs_" + os.path.splitext(os.path.basename(file_path))[0]
 
 
-def progenum(iterable, freq):
+def gtfs_file_names(source):
+    """Returns the names of the files in source, a folder or a GTFS zip file"""
+    if os.path.isdir(source):
+        return os.listdir(source)
+    with zipfile.ZipFile(source) as z:
+        return [name for name in z.namelist() if not name.endswith('/')]
+
+
+def gtfs_file_size(source, file_name):
+    """Returns the (uncompressed) size of a file in source, a folder or a GTFS zip file"""
+    if os.path.isdir(source):
+        return os.path.getsize(os.path.join(source, file_name))
+    with zipfile.ZipFile(source) as z:
+        return z.getinfo(file_name).file_size
+
+
+@contextlib.contextmanager
+def open_gtfs_file(source, file_name):
+    """
+    Opens a file in source, a folder or a GTFS zip file, for reading text. Zip members are decompressed while they
+    are read, so the zip isn't extracted to the disk, and only a small buffer of the file is in memory at a time.
+    """
+    if os.path.isdir(source):
+        with open(os.path.join(source, file_name), encoding='utf-8-sig') as f:
+            yield f
+    else:
+        with zipfile.ZipFile(source) as z, z.open(file_name) as member:
+            yield io.TextIOWrapper(member, encoding='utf-8-sig')
+
+
+def progenum(iterable, freq, label=''):
     """A primitive progress bar"""
     i = 0
     for i, r in enumerate(iterable):
         yield r
         if i % freq == 0:
-            print(' %s Read %d records' % (datetime.datetime.now(), i))
-    print(' Total number of records: %d' % i)
+            print(' %s %sRead %d records' % (datetime.datetime.now(), label, i))
+    print(' %sTotal number of records: %d' % (label, i))
 
 
-def insert_file_to_db(file_path, cursor, table_name, columns, query_template, conn_obj):
+def insert_file_to_db(f, cursor, table_name, columns, query_template, conn_obj):
     """
-    file path - the path of the file containing data, notice - the name
+    f - the file containing data (see open_gtfs_file), notice - the name
     of the file must match to the table e.g. agency.txt to table agency
     conn_obj - connection object to postgres received in connect method
     table_name - name of the table to write to
@@ -91,51 +132,526 @@ def insert_file_to_db(file_path, cursor, table_name, columns, query_template, co
     query template - template for queries in postgres
     """
     print("Importing data to table %s" % table_name)
-    with open(file_path, encoding='utf-8') as f:
-        # find indices of columns in the postgres actual table
-        reader = progenum(csv.DictReader(f), 1000)
-        for row in reader:
-            values = []
-            placeholder = []
-            for col_name, col_type in columns:
-                if col_type == "integer" and row[col_name] == '':
-                    values.append(None)
+    # find indices of columns in the postgres actual table
+    reader = progenum(csv.DictReader(f), 1000)
+    for row in reader:
+        values = []
+        placeholder = []
+        for col_name, col_type in columns:
+            if col_type == "integer" and row[col_name] == '':
+                values.append(None)
+            else:
+                values.append(row[col_name])
+            placeholder.append("%s")
+
+        query = query_template.render(columns=list(zip(*columns))[0], values=placeholder, table_name=table_name)
+        try:
+            cursor.execute(query, values)
+            conn_obj.commit()
+        except Exception as e:
+            print(e)
+            print(row)
+            conn_obj.rollback()
+
+
+# number of rows sent in every COPY command. When a COPY fails, its rows are retried in smaller batches to find the
+# rejected rows, so this is also the most rows we re-send because of a single bad row
+COPY_BATCH_SIZE = 100000
+
+
+def copy_escape(value):
+    """Escapes a value for the COPY text format"""
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def copy_file_to_db(f, cursor, table_name, columns, conn_obj, rejects_folder):
+    """
+    Loads a GTFS file (see open_gtfs_file) to table_name with COPY ... FROM STDIN, in batches of COPY_BATCH_SIZE rows,
+    in one transaction. Returns a tuple (number of rows, number of rejected rows). See copy_lines_to_db().
+    """
+    print("Copying data to table %s" % table_name)
+    header = next(csv.reader([next(f)]))
+    return copy_lines_to_db(f, header, cursor, table_name, columns, conn_obj,
+                            os.path.join(rejects_folder, table_name + '.rejects.csv'))
+
+
+def copy_lines_to_db(lines, header, cursor, table_name, columns, conn_obj, rejects_file, label=''):
+    """
+    Loads csv lines (without the header) to table_name with COPY ... FROM STDIN, in batches of COPY_BATCH_SIZE rows,
+    in one transaction. Returns a tuple (number of rows, number of rejected rows).
+
+    columns is a list of tuples of column name and data type, from the mapping file. Empty values of non character
+    columns are sent as NULL. Rows that postgres rejects are written to rejects_file, with the error, and the rest of
+    the rows are loaded.
+    """
+    query = "COPY %s (%s) FROM STDIN" % (table_name, ', '.join(col_name for col_name, _ in columns))
+    rejects = []
+    missing = [col_name for col_name, _ in columns if col_name not in header]
+    if len(missing) > 0:
+        print(" Columns %s are missing in %s, they will be NULL" % (', '.join(missing), table_name))
+    indexes = [header.index(col_name) if col_name in header else None for col_name, _ in columns]
+    nullable = [not col_type.startswith('character') for _, col_type in columns]
+
+    def copy_line(row):
+        values = []
+        for i, can_be_null in zip(indexes, nullable):
+            value = row[i] if i is not None and i < len(row) else ''
+            values.append('\\N' if value == '' and (can_be_null or i is None) else copy_escape(value))
+        return '\t'.join(values) + '\n'
+
+    row_count = 0
+    rows = progenum(csv.reader(lines), 1000000, label)
+    for batch in iter(lambda: list(itertools.islice(rows, COPY_BATCH_SIZE)), []):
+        copy_rows(cursor, query, [(copy_line(row), row) for row in batch], rejects)
+        row_count += len(batch)
+    conn_obj.commit()
+    if len(rejects) > 0:
+        print(" %s%d rows rejected, see %s" % (label, len(rejects), rejects_file))
+        with open(rejects_file, 'w', encoding='utf-8') as f:
+            writer = csv.writer(f, lineterminator='\n')
+            writer.writerow(header + ['error'])
+            writer.writerows(row + [error] for row, error in rejects)
+    return row_count, len(rejects)
+
+
+def copy_rows(cursor, query, lines_and_rows, rejects):
+    """
+    Copies a batch of (COPY line, original row) tuples. If postgres rejects the batch, it is rolled back to a savepoint
+    and split in two, until the bad rows are found and added to rejects, as (row, error message) tuples.
+    """
+    cursor.execute("SAVEPOINT copy_batch")
+    try:
+        cursor.copy_expert(query, io.StringIO(''.join(line for line, _ in lines_and_rows)))
+        cursor.execute("RELEASE SAVEPOINT copy_batch")
+    except psycopg2.Error as e:
+        cursor.execute("ROLLBACK TO SAVEPOINT copy_batch")
+        if len(lines_and_rows) == 1:
+            rejects.append((lines_and_rows[0][1], str(e).strip()))
+            return
+        middle = len(lines_and_rows) // 2
+        copy_rows(cursor, query, lines_and_rows[:middle], rejects)
+        copy_rows(cursor, query, lines_and_rows[middle:], rejects)
+
+
+# files larger than this are split to chunks of about this size, that are loaded concurrently in parallel mode
+PARALLEL_CHUNK_SIZE = 64 * 1024 * 1024
+
+
+def read_lines(file_path, start, end):
+    """Yields the lines in the byte range [start, end) of the file, which has to start and end at line boundaries"""
+    with open(file_path, 'rb') as f:
+        f.seek(start)
+        position = start
+        for line in f:
+            if position >= end:
+                break
+            position += len(line)
+            yield line.decode('utf-8')
+
+
+def copy_lines_over_connection(connection_string, lines, header, table_name, columns, rejects_file, label):
+    """
+    Runs copy_lines_to_db over a connection of its own. Returns (rows, rejected rows, start time, end time), with the
+    times as time.time() values.
+    """
+    conn_obj = psycopg2.connect(connection_string)
+    try:
+        started = time.time()
+        rows, rejected = copy_lines_to_db(lines, header, conn_obj.cursor(), table_name, columns, conn_obj,
+                                          rejects_file, label)
+        return rows, rejected, started, time.time()
+    finally:
+        conn_obj.close()
+
+
+def copy_chunk_to_db(connection_string, file_path, header, start, end, table_name, columns, rejects_file, label):
+    """Loads the lines in a byte range of a GTFS file. Runs in a worker process."""
+    return copy_lines_over_connection(connection_string, read_lines(file_path, start, end), header, table_name,
+                                      columns, rejects_file, label)
+
+
+def copy_member_to_db(connection_string, source, file_name, table_name, columns, rejects_file, label):
+    """Loads a whole file of a GTFS folder or zip file. Runs in a worker process."""
+    with open_gtfs_file(source, file_name) as f:
+        header = next(csv.reader([next(f)]))
+        return copy_lines_over_connection(connection_string, f, header, table_name, columns, rejects_file, label)
+
+
+def parallel_copy_folder_to_db(source, files, mapping, connection_string, rejects_folder, processes):
+    """
+    Loads the files to the db with COPY, using a pool of processes with a connection each. Different tables are loaded
+    concurrently, and files of a folder that are larger than PARALLEL_CHUNK_SIZE are split to chunks that are loaded
+    concurrently too (every chunk is committed separately). The members of a zip file can't be split, since they are
+    decompressed as a stream, so each is loaded by one process. Progress and throughput are reported per table.
+    Returns the names of the tables that failed to load.
+    """
+    # (size, table name, chunk name, worker function, arguments after the connection string)
+    tasks = []
+    for file in files:
+        table_name = get_table_name(file)
+        size = gtfs_file_size(source, file)
+        if not os.path.isdir(source) or size <= PARALLEL_CHUNK_SIZE:
+            tasks.append((size, table_name, table_name, copy_member_to_db, (source, file)))
+            continue
+        file_path = os.path.join(source, file)
+        header, ranges = split_csv_file(file_path, -(-size // PARALLEL_CHUNK_SIZE))
+        for i, (start, end) in enumerate(ranges):
+            tasks.append((end - start, table_name, '%s.%d' % (table_name, i), copy_chunk_to_db,
+                          (file_path, header, start, end)))
+
+    table_futures = {}
+    with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+        # the biggest chunks first, so the pool is busy until the end
+        for _, table_name, name, worker, args in sorted(tasks, key=lambda task: -task[0]):
+            future = executor.submit(worker, connection_string, *args, table_name, mapping[table_name],
+                                     os.path.join(rejects_folder, name + '.rejects.csv'), '%s: ' % name)
+            table_futures.setdefault(table_name, []).append(future)
+        print("Loading %d tables in %d chunks with %d processes" % (len(table_futures), len(tasks), processes))
+
+        failed_tables = []
+        remaining = {future: table_name for table_name, futures in table_futures.items() for future in futures}
+        for future in concurrent.futures.as_completed(list(remaining)):
+            table_name = remaining.pop(future)
+            if table_name in remaining.values():
+                continue
+            if not report_table(table_name, table_futures[table_name]):
+                failed_tables.append(table_name)
+    return failed_tables
+
+
+def report_table(table_name, futures):
+    """
+    Prints the result of loading all the chunks of a table. The time is from the start of its first chunk to the end
+    of its last one, so time spent waiting in the pool queue isn't counted. Returns False if any chunk failed.
+    """
+    rows, rejected, failed = 0, 0, 0
+    started, finished = [], []
+    for future in futures:
+        if future.exception() is not None:
+            print("%s: a chunk failed: %s" % (table_name, future.exception()))
+            failed += 1
+        else:
+            rows += future.result()[0]
+            rejected += future.result()[1]
+            started.append(future.result()[2])
+            finished.append(future.result()[3])
+    elapsed = max(finished) - min(started) if len(started) > 0 else 0
+    print("%s: %d rows loaded (%d rejected) in %.1f seconds, %.0f rows/second%s" %
+          (table_name, rows - rejected, rejected, elapsed, rows / max(elapsed, 0.001),
+           ", %d of %d chunks failed" % (failed, len(futures)) if failed > 0 else ''))
+    return failed == 0
+
+
+def serial_load_folder_to_db(source, files, mapping, connection_string, mode, query_template, rejects_folder):
+    """Loads the files to the db one by one, over a single connection. Returns the names of the tables that failed."""
+    conn_obj = connect(connection_string)
+    cursor = conn_obj.cursor()
+    failed_tables = []
+    for file in files:
+        table_name = get_table_name(file)
+        try:
+            with open_gtfs_file(source, file) as f:
+                if mode == 'copy':
+                    copy_file_to_db(f, cursor, table_name, mapping[table_name], conn_obj, rejects_folder)
                 else:
-                    values.append(row[col_name])
-                placeholder.append("%s")
+                    insert_file_to_db(f, cursor, table_name, mapping[table_name], query_template, conn_obj)
+        except Exception as e:
+            conn_obj.rollback()
+            print(file + " failed")
+            print(e)
+            failed_tables.append(table_name)
+    conn_obj.close()
+    return failed_tables
+
+
+def create_staging_tables(conn_obj, schema, table_names):
+    """
+    (Re)creates schema with an empty copy of every table, with the columns, defaults and check constraints of the live
+    table in public, but without its indexes and other constraints, so loading it runs at the speed of a bare COPY
+    """
+    cursor = conn_obj.cursor()
+    cursor.execute("DROP SCHEMA IF EXISTS %s CASCADE" % schema)
+    cursor.execute("CREATE SCHEMA %s" % schema)
+    for table_name in table_names:
+        cursor.execute("CREATE TABLE %s.%s (LIKE public.%s INCLUDING DEFAULTS INCLUDING CONSTRAINTS)" %
+                       (schema, table_name, table_name))
+    conn_obj.commit()
+
+
+def index_staging_tables(conn_obj, schema, table_names):
+    """
+    Adds the constraints, indexes and privileges of the live tables to the loaded staging tables, and analyzes them.
+    Foreign keys to live tables that are replaced refer to their staging tables instead, and are added last, when the
+    keys they refer to exist.
+    """
+    cursor = conn_obj.cursor()
+    foreign_keys = []
+    for table_name in table_names:
+        print("Indexing %s.%s" % (schema, table_name))
+        live_table = 'public.' + table_name
+        cursor.execute("SELECT conname, contype, pg_get_constraintdef(oid) FROM pg_constraint "
+                       "WHERE conrelid = %s::regclass AND contype IN ('p', 'u', 'f', 'x')", (live_table,))
+        constraints = cursor.fetchall()
+        for name, constraint_type, definition in constraints:
+            if constraint_type == 'f':
+                # the staging table hides the live one in the search path, so pg_get_constraintdef qualifies it
+                definition = re.sub(r'REFERENCES public\.(\w+)\(',
+                                    lambda m: 'REFERENCES %s.%s(' % (schema if m.group(1) in table_names else 'public',
+                                                                     m.group(1)),
+                                    definition)
+                foreign_keys.append((table_name, name, definition))
+            else:
+                cursor.execute("ALTER TABLE %s.%s ADD CONSTRAINT %s %s" % (schema, table_name, name, definition))
+        # the indexes of primary key, unique and exclusion constraints are created with the constraints
+        cursor.execute("SELECT indexname, indexdef FROM pg_indexes WHERE schemaname = 'public' AND tablename = %s",
+                       (table_name,))
+        for name, definition in cursor.fetchall():
+            if name not in {constraint_name for constraint_name, _, _ in constraints}:
+                cursor.execute(re.sub(r' ON (public\.)?%s ' % table_name, ' ON %s.%s ' % (schema, table_name),
+                                      definition, count=1))
+        cursor.execute("SELECT CASE WHEN a.grantee = 0 THEN 'PUBLIC' ELSE quote_ident(r.rolname) END, "
+                       "a.privilege_type FROM pg_class c CROSS JOIN LATERAL aclexplode(c.relacl) a "
+                       "LEFT JOIN pg_roles r ON r.oid = a.grantee "
+                       "WHERE c.oid = %s::regclass AND a.grantee <> c.relowner", (live_table,))
+        for grantee, privilege in cursor.fetchall():
+            cursor.execute("GRANT %s ON %s.%s TO %s" % (privilege, schema, table_name, grantee))
+        cursor.execute("ANALYZE %s.%s" % (schema, table_name))
+        conn_obj.commit()
+
+    for table_name, name, definition in foreign_keys:
+        cursor.execute("ALTER TABLE %s.%s ADD CONSTRAINT %s %s" % (schema, table_name, name, definition))
+    conn_obj.commit()
+
+
+def swap_staging_tables(conn_obj, schema, table_names):
+    """
+    Replaces the live tables with the staging tables, in a single transaction, and drops the staging schema. Readers
+    of the live tables see either the old feed or the new one; they only wait for the short swap transaction.
+    Returns False, leaving the live tables as they were, if the swap failed.
+    """
+    cursor = conn_obj.cursor()
+    print("Replacing %s with the tables of schema %s" % (', '.join(table_names), schema))
+    try:
+        # sequences of serial columns belong to the live table, and would be dropped with it. A sequence can only
+        # belong to a table in its own schema, so it's released here, and given to the new table once it's in public
+        serial_columns = []
+        for table_name in table_names:
+            cursor.execute("SELECT attname, pg_get_serial_sequence(%s, attname) FROM pg_attribute "
+                           "WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped",
+                           ('public.' + table_name, 'public.' + table_name))
+            for column, sequence in cursor.fetchall():
+                if sequence is not None:
+                    cursor.execute("ALTER SEQUENCE %s OWNED BY NONE" % sequence)
+                    serial_columns.append((sequence, table_name, column))
+        if len(table_names) > 0:
+            # dropped together, since foreign keys between the live tables would prevent dropping them one by one
+            cursor.execute("DROP TABLE %s" % ', '.join('public.' + table_name for table_name in table_names))
+        for table_name in table_names:
+            cursor.execute("ALTER TABLE %s.%s SET SCHEMA public" % (schema, table_name))
+        for sequence, table_name, column in serial_columns:
+            cursor.execute("ALTER SEQUENCE %s OWNED BY public.%s.%s" % (sequence, table_name, column))
+        conn_obj.commit()
+        return True
+    except psycopg2.Error as e:
+        conn_obj.rollback()
+        print("Replacing the live tables failed, they weren't changed: %s" % e)
+        return False
+    finally:
+        cursor.execute("DROP SCHEMA IF EXISTS %s CASCADE" % schema)
+        conn_obj.commit()
+
+
+# the columns that identify a record in each GTFS file, to find the changes between feeds in incremental mode
+FEED_KEYS = {
+    'gtfs_agency': ['agency_id'],
+    'gtfs_routes': ['route_id'],
+    'gtfs_trips': ['trip_id'],
+    'gtfs_calendar': ['service_id'],
+    'gtfs_stop_times': ['trip_id', 'stop_sequence'],
+    'gtfs_stops': ['stop_id'],
+    'gtfs_shapes': ['shape_id', 'shape_pt_sequence'],
+}
+
 
-            query = query_template.render(columns=list(zip(*columns))[0], values=placeholder, table_name=table_name)
-            try:
-                cursor.execute(query, values)
-                conn_obj.commit()
-            except Exception as e:
-                print(e)
-                print(row)
-                conn_obj.rollback()
+def keyed_rows(lines, header, key_columns, columns, max_lines_in_memory):
+    """
+    Yields a tuple (key, values, row) for every csv line, sorted by key (external_sort). values are the values of
+    columns, so rows of files with different column orders can be compared.
+    """
+    key_indexes = [header.index(col_name) for col_name in key_columns]
+    value_indexes = [header.index(col_name) if col_name in header else None for col_name in columns]
+
+    def key(line):
+        row = next(csv.reader([line]))
+        return tuple(row[i] for i in key_indexes)
+
+    for line in external_sort(lines, key, max_lines_in_memory):
+        row = next(csv.reader([line]))
+        yield (tuple(row[i] for i in key_indexes),
+               tuple(row[i] if i is not None and i < len(row) else '' for i in value_indexes),
+               row)
+
+
+def diff_rows(old_rows, new_rows):
+    """
+    Merges two sorted iterables of keyed_rows(). Yields a tuple (change, key, row) for every key that was added
+    ('insert', with the new row), changed ('update', with the new row) or removed ('delete', with the old row).
+    """
+    old_rows, new_rows = iter(old_rows), iter(new_rows)
+    old, new = next(old_rows, None), next(new_rows, None)
+    while old is not None or new is not None:
+        if new is None or (old is not None and old[0] < new[0]):
+            yield 'delete', old[0], old[2]
+            old = next(old_rows, None)
+        elif old is None or new[0] < old[0]:
+            yield 'insert', new[0], new[2]
+            new = next(new_rows, None)
+        else:
+            if old[1] != new[1]:
+                yield 'update', new[0], new[2]
+            old, new = next(old_rows, None), next(new_rows, None)
+
+
+def upsert_file_to_db(previous_source, source, file_name, conn_obj, table_name, columns, rejects_folder,
+                      max_lines_in_memory):
+    """
+    Applies the changes in a GTFS file between the previous feed (previous_source, which is loaded to the db) and the
+    new one (source) to table_name. The changed rows and the keys of the removed and changed rows are copied to
+    temporary tables, and then the table is updated with a single DELETE and a single INSERT, in one transaction.
+    If any of these rows is rejected, the table isn't updated at all, and a ValueError is raised.
+    """
+    key_columns = FEED_KEYS[table_name]
+    print("Comparing %s to the previous feed" % file_name)
+    with open_gtfs_file(source, file_name) as f, tempfile.TemporaryFile('w+', encoding='utf-8') as upserts, \
+            tempfile.TemporaryFile('w+', encoding='utf-8') as deletes:
+        header = next(csv.reader([next(f)]))
+        new_rows = keyed_rows(f, header, key_columns, [col_name for col_name, _ in columns], max_lines_in_memory)
+        counts = {'insert': 0, 'update': 0, 'delete': 0}
+        upserts_writer = csv.writer(upserts, lineterminator='\n')
+        deletes_writer = csv.writer(deletes, lineterminator='\n')
+        with contextlib.ExitStack() as stack:
+            old_rows = []
+            if file_name in gtfs_file_names(previous_source):
+                previous = stack.enter_context(open_gtfs_file(previous_source, file_name))
+                previous_header = next(csv.reader([next(previous)]))
+                old_rows = keyed_rows(previous, previous_header, key_columns, [col_name for col_name, _ in columns],
+                                      max_lines_in_memory)
+            for change, key, row in diff_rows(old_rows, new_rows):
+                counts[change] += 1
+                if change != 'insert':
+                    deletes_writer.writerow(key)
+                if change != 'delete':
+                    upserts_writer.writerow(row)
+        print("%s: %d inserted, %d updated, %d deleted" %
+              (table_name, counts['insert'], counts['update'], counts['delete']))
+        if counts['insert'] + counts['update'] + counts['delete'] == 0:
+            return
+
+        cursor = conn_obj.cursor()
+        cursor.execute("CREATE TEMP TABLE %s_upserts AS SELECT %s FROM %s WITH NO DATA" %
+                       (table_name, ', '.join(col_name for col_name, _ in columns), table_name))
+        cursor.execute("CREATE TEMP TABLE %s_deletes AS SELECT %s FROM %s WITH NO DATA" %
+                       (table_name, ', '.join(key_columns), table_name))
+        conn_obj.commit()
+        upserts.seek(0)
+        _, rejected_upserts = copy_lines_to_db(upserts, header, cursor, table_name + '_upserts', columns, conn_obj,
+                                               os.path.join(rejects_folder, table_name + '.rejects.csv'))
+        deletes.seek(0)
+        _, rejected_deletes = copy_lines_to_db(deletes, key_columns, cursor, table_name + '_deletes',
+                                               [column for column in columns if column[0] in key_columns], conn_obj,
+                                               os.path.join(rejects_folder, table_name + '.deletes.rejects.csv'))
+        if rejected_upserts + rejected_deletes > 0:
+            # applying the rest of the changes would lose the old versions of rejected rows, or duplicate them
+            cursor.execute("DROP TABLE %s_upserts, %s_deletes" % (table_name, table_name))
+            conn_obj.commit()
+            raise ValueError("%d changed rows were rejected, so %s wasn't updated" %
+                             (rejected_upserts + rejected_deletes, table_name))
+
+        cursor.execute("DELETE FROM %s USING %s_deletes d WHERE %s" %
+                       (table_name, table_name,
+                        ' AND '.join('%s.%s = d.%s' % (table_name, col_name, col_name) for col_name in key_columns)))
+        cursor.execute("INSERT INTO %s (%s) SELECT %s FROM %s_upserts" %
+                       (table_name, ', '.join(col_name for col_name, _ in columns),
+                        ', '.join(col_name for col_name, _ in columns), table_name))
+        cursor.execute("DROP TABLE %s_upserts, %s_deletes" % (table_name, table_name))
+        conn_obj.commit()
+
+
+def upsert_folder_to_db(previous_source, source, files, mapping, connection_string, rejects_folder,
+                        max_lines_in_memory):
+    """Applies the changes in the files since the previous feed. Returns the names of the tables that failed."""
+    conn_obj = connect(connection_string)
+    failed_tables = []
+    for file in files:
+        table_name = get_table_name(file)
+        try:
+            upsert_file_to_db(previous_source, source, file, conn_obj, table_name, mapping[table_name],
+                              rejects_folder, max_lines_in_memory)
+        except Exception as e:
+            conn_obj.rollback()
+            print(file + " failed")
+            print(e)
+            failed_tables.append(table_name)
+    conn_obj.close()
+    return failed_tables
 
 
 def insert_folder_to_db(folder, db_config):
+    """
+    Loads the GTFS files in folder, which can also be a GTFS zip file, to the db. If staging_schema is set in the
+    config, the files are loaded to copies of the tables in that schema, which replace the live tables when all of
+    them are loaded and indexed.
+    """
     env = Environment(loader=FileSystemLoader(TEMPLATES_PATH))
     conn_template = env.get_template(CONNECTION_TEMPLATE_FILE_NAME)
     connection_string = build_connection_string(db_config, conn_template)
-    conn_obj = connect(connection_string)
-    cursor = conn_obj.cursor()
     query_template = env.get_template(QUERY_TEMPLATE_FILE_NAME)
     mapping = load_mapping(os.path.join(DATA_DIR, MAPPING_FILE))
+    # copy (the default) loads every file with COPY; insert runs an INSERT per row; incremental applies the changes
+    # since previous_gtfs
+    mode = db_config.get('mode') or 'copy'
+    if mode == 'incremental' and not db_config.get('previous_gtfs'):
+        raise ValueError("previous_gtfs has to be set in incremental mode")
+    rejects_folder = db_config.get('rejects_folder') or (folder if os.path.isdir(folder) else os.path.dirname(folder))
+    processes = int(db_config['processes']) if db_config.get('processes') else None
+    staging_schema = db_config.get('staging_schema') if mode != 'incremental' else None
 
-    for file in os.listdir(folder):
-        table_name = get_table_name(file)
-        if table_name in mapping:
-            try:
-                insert_file_to_db(os.path.join(folder, file), cursor,
-                                  table_name, mapping[table_name], query_template, conn_obj)
-            except Exception as e:
-                print(file + " failed")
-                print(e)
+    files = []
+    for file in gtfs_file_names(folder):
+        if get_table_name(file) in mapping:
+            files.append(file)
         else:
-            print("Mapping doesn't contain table matching %s, can't import" % table_name)
+            print("Mapping doesn't contain table matching %s, can't import" % get_table_name(file))
+    table_names = [get_table_name(file) for file in files]
 
-    conn_obj.close()
+    if staging_schema:
+        conn_obj = connect(connection_string)
+        create_staging_tables(conn_obj, staging_schema, table_names)
+        conn_obj.close()
+        # the table names in the queries aren't qualified, so they refer to the staging tables
+        # (options goes first, since an empty value at the end of the template would take it as its value)
+        connection_string = "options='-c search_path=%s,public' %s" % (staging_schema, connection_string)
+
+    if mode == 'incremental':
+        failed_tables = upsert_folder_to_db(db_config['previous_gtfs'], folder, files, mapping, connection_string,
+                                            rejects_folder, int(db_config.get('max_records_in_memory') or 1000000))
+    elif mode == 'copy' and processes is not None:
+        failed_tables = parallel_copy_folder_to_db(folder, files, mapping, connection_string, rejects_folder, processes)
+    else:
+        failed_tables = serial_load_folder_to_db(folder, files, mapping, connection_string, mode, query_template,
+                                                 rejects_folder)
+
+    if staging_schema:
+        if len(failed_tables) > 0:
+            print("%s failed, so the live tables weren't replaced. The loaded tables are in schema %s" %
+                  (', '.join(failed_tables), staging_schema))
+            return
+        conn_obj = connect(connection_string)
+        try:
+            index_staging_tables(conn_obj, staging_schema, table_names)
+            swap_staging_tables(conn_obj, staging_schema, table_names)
+        finally:
+            conn_obj.close()
 
 
 def main():
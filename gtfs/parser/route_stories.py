@@ -57,21 +57,36 @@ Why is this good?
 
 """
 
+import concurrent.futures
 import csv
+import hashlib
+import heapq
+import itertools
 import os
+import queue
 import sys
+import tempfile
+import threading
+import zlib
+from array import array
 from collections import defaultdict, namedtuple
+from collections.abc import Mapping
 from configparser import ConfigParser
 
-from gtfs.parser.gtfs_reader import StopTime
+from gtfs.parser.external_sort import external_sort
+from gtfs.parser.gtfs_reader import StopTime, StopTimesStore, split_csv_file, read_stop_times_chunk
 import logging
 
 try:
     import psycopg2
-    import psycopg2.extras
 except ImportError as e:
     print("Failed to import psycopg2, db functionality will fail")
 
+try:
+    import numpy as np
+except ImportError:
+    print("Failed to import numpy, the binary route stories format will fail")
+
 
 def parse_config(config_file_name):
     with open(config_file_name) as f:
@@ -95,6 +110,8 @@ def format_time(seconds_from_midnight):
 
 
 class RouteStoryStop:
+    __slots__ = ('arrival_offset', 'departure_offset', 'stop_id', 'pickup_type', 'drop_off_type', 'stop_sequence')
+
     def __init__(self, arrival_offset, departure_offset, stop_id, stop_sequence, pickup_type, drop_off_type):
         self.arrival_offset = arrival_offset
         self.departure_offset = departure_offset
@@ -132,6 +149,12 @@ class RouteStory:
         self.route_story_id = route_story_id
         self.stops = stops
 
+    def fingerprint(self):
+        """Returns a hex digest of the content of the route story, stable across runs and feeds"""
+        return hashlib.sha1(pack_route_story_stops(
+            (stop.arrival_offset, stop.departure_offset, stop.stop_id, stop.pickup_type, stop.drop_off_type)
+            for stop in self.stops)).hexdigest()
+
     def __eq__(self, other):
         return self.route_story_id == other.route_story_id
 
@@ -140,55 +163,212 @@ class RouteStory:
 
 
 TripRouteStory = namedtuple('TripRouteStory', 'start_time route_story')
+StopCall = namedtuple('StopCall', 'route_story_id stop_sequence arrival_offset')
 
 
-def stop_times_file_generator(stop_times_file):
-    """Yields a sequence of (trip_id, StopTime) tuples read from gtfs stop_times.txt file"""
+def stop_times_file_generator(stop_times_file, processes=None, max_records_in_memory=None, presorted=False):
+    """
+    Yields a sequence of (trip_id, StopTime) tuples read from gtfs stop_times.txt file, sorted by trip_id and
+    stop_sequence. If processes is given, the file is split to chunks that are parsed in parallel.
+
+    Otherwise the file is sorted with an external sort, holding at most max_records_in_memory records in memory (all of
+    them if it's None). With presorted=True the file isn't sorted at all: the records of each trip are assumed to be
+    consecutive in the file, and the trips are yielded in file order, with only one trip in memory at a time.
+    """
+    if processes is not None:
+        return parallel_stop_times_file_generator(stop_times_file, processes)
+    if presorted:
+        return grouped_stop_times_file_generator(stop_times_file)
+    return sorted_stop_times_file_generator(stop_times_file, max_records_in_memory)
+
+
+def stop_times_line_key(header):
+    """Returns a sort key for stop_times.txt lines with the given header: (trip_id, stop_sequence)"""
+    trip_col = header.index('trip_id')
+    stop_sequence_col = header.index('stop_sequence')
 
     def key(line):
-        tokens = line.strip().split(',')
-        return tokens[0], int(tokens[4])
+        tokens = line.split(',')
+        return tokens[trip_col], int(tokens[stop_sequence_col])
+
+    return key
+
+
+def sorted_stop_times_file_generator(stop_times_file, max_records_in_memory):
+    with open(stop_times_file, encoding='utf8') as f:
+        header = next(csv.reader([next(f)]))
+        key = stop_times_line_key(header)
+        for line in external_sort(f, key, max_records_in_memory):
+            yield key(line)[0], StopTime.from_line(line)
 
-    def line_to_trip_and_stop_time(line):
-        return line.partition(',')[0], StopTime.from_line(line)
 
+def grouped_stop_times_file_generator(stop_times_file):
     with open(stop_times_file, encoding='utf8') as f:
-        next(f)
-        lines = sorted(f.readlines(), key=key)
-        return (line_to_trip_and_stop_time(line) for line in lines)
+        header = next(csv.reader([next(f)]))
+        key = stop_times_line_key(header)
+        seen_trip_ids = set()
+        for trip_id, lines in itertools.groupby(f, key=lambda line: key(line)[0]):
+            if trip_id in seen_trip_ids:
+                raise ValueError("Records of trip %s are not consecutive in %s. Set presorted to false." %
+                                 (trip_id, stop_times_file))
+            seen_trip_ids.add(trip_id)
+            for line in sorted(lines, key=key):
+                yield trip_id, StopTime.from_line(line)
+
+
+def parallel_stop_times_file_generator(stop_times_file, processes):
+    header, ranges = split_csv_file(stop_times_file, processes)
+    logging.debug("Parsing %s in %d chunks" % (stop_times_file, len(ranges)))
+    with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+        futures = [executor.submit(read_stop_times_chunk, stop_times_file, header, start, end) for start, end in ranges]
+        store = StopTimesStore.merge([f.result() for f in futures])
+    logging.debug("%d records read for %d trips" % (len(store), len(store.trip_ids)))
+    for trip_id in sorted(store.trip_ids):
+        for stop_time in store.stop_times(trip_id):
+            yield trip_id, stop_time
+
+
+STOP_TIMES_COPY_QUERY = "COPY (SELECT trip_id,arrival_time,departure_time,stop_id,stop_sequence,drop_off_only," \
+                        "pickup_only FROM gtfs_stop_times ORDER BY trip_id, stop_sequence) TO STDOUT"
+
+
+class QueueWriter:
+    """
+    A file-like object that passes what is written to it to a queue, in buffers of at least buffer_size bytes.
+    Used to stream the output of psycopg2's copy_expert, which writes to a file, to another thread. Once stop_event is
+    set, writing raises CopyStopped, so the copy doesn't wait forever for a reader that is gone.
+    """
+
+    def __init__(self, data_queue, stop_event, buffer_size=1024 * 1024):
+        self.queue = data_queue
+        self.stop_event = stop_event
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.buffered = 0
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf8')
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffered > 0:
+            self.put(b''.join(self.buffer))
+            self.buffer = []
+            self.buffered = 0
+
+    def put(self, item):
+        while True:
+            if self.stop_event.is_set():
+                raise CopyStopped()
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+
+class CopyStopped(Exception):
+    """Raised by QueueWriter when the reader of the queue stopped reading"""
+
+
+def copy_to_queue(connection, query, data_queue, stop_event):
+    """
+    Runs a COPY ... TO STDOUT query, putting its output in data_queue, followed by None (or the exception). Stops when
+    stop_event is set.
+    """
+    writer = QueueWriter(data_queue, stop_event)
+    try:
+        try:
+            connection.cursor().copy_expert(query, writer)
+            writer.flush()
+            writer.put(None)
+        except Exception as e:
+            writer.put(e)
+    except CopyStopped:
+        pass
+
+
+def copy_lines(connection, query, max_buffers=16):
+    """
+    Yields the lines (as bytes, without the line ending) of the output of a COPY ... TO STDOUT query. The query runs in
+    a separate thread, so reading from the db and processing the lines overlap. If the caller stops iterating early, the
+    query is cancelled and the thread is stopped.
+    """
+    data_queue = queue.Queue(max_buffers)
+    stop_event = threading.Event()
+    thread = threading.Thread(target=copy_to_queue, args=(connection, query, data_queue, stop_event), daemon=True)
+    thread.start()
+    try:
+        leftover = b''
+        while True:
+            data = data_queue.get()
+            if data is None:
+                break
+            if isinstance(data, Exception):
+                raise data
+            lines = (leftover + data).split(b'\n')
+            leftover = lines.pop()
+            yield from lines
+        if leftover != b'':
+            yield leftover
+    finally:
+        stop_event.set()
+        if thread.is_alive():
+            connection.cancel()
+        thread.join()
+
+
+def parse_copy_stop_times(lines):
+    """
+    Parses the lines of STOP_TIMES_COPY_QUERY (COPY text format). Yields (trip_id, StopTime) tuples, with the same
+    values the rows of a regular query would have.
+    """
+    booleans = {'t': True, 'f': False, '\\N': None}
+    # there are only 86400 seconds in a day (give or take), so the timestamps repeat a lot
+    timestamps = {}
+    for line in lines:
+        trip_id, arrival, departure, stop_id, stop_sequence, drop_off_only, pickup_only = line.decode('utf8').split('\t')
+        if arrival not in timestamps:
+            timestamps[arrival] = parse_timestamp(arrival)
+        if departure not in timestamps:
+            timestamps[departure] = parse_timestamp(departure)
+        yield trip_id, StopTime(timestamps[arrival], timestamps[departure], int(stop_id), int(stop_sequence),
+                                booleans[drop_off_only], booleans[pickup_only])
 
 
 def stop_times_db_generator(config):
-    def total_records():
+    """Yields a sequence of (trip_id, StopTime) tuples read from db, sorted by trip_id and stop_sequence"""
+
+    def estimated_records():
+        # COUNT(*) scans the whole table; the planner statistics are good enough for progress reports
         c = connection.cursor()
-        c.execute("SELECT COUNT(*) FROM stop_times;")
-        return c.fetchone()[0]
+        c.execute("SELECT reltuples::BIGINT FROM pg_class WHERE oid = 'public.gtfs_stop_times'::regclass;")
+        row = c.fetchone()
+        return max(row[0], 1) if row is not None else 1
 
     def progress(iterable):
         for i, value in enumerate(iterable):
             if i % 1000000 == 0 and i > 0:
-                logging.debug("%dM records read (%.1f%%)" % (i / 1000000, 100 * i / total_records))
+                logging.debug("%dM records read (about %.1f%%)" % (i / 1000000, 100 * i / total_records))
             yield value
 
-    """Yields a sequence of (trip_id, StopTime) tuples read from db"""
     template = "dbname={d[db_name]} user={d[db_user]} host={d[db_host]} password={d[db_password]}"
     connection_str = template.format(d=config)
     logging.debug("Connection to db")
     connection = psycopg2.connect(connection_str)
-    logging.debug("Fetching total number of records")
-    total_records = total_records()
-    logging.debug("There are %d records in stop_times table" % total_records)
-    logging.debug("Creating cursor")
-    cursor = connection.cursor('read_stop_times_from_db', cursor_factory=psycopg2.extras.DictCursor)
-    logging.debug("Executing select query")
-    cursor.execute("SELECT trip_id,arrival_time,departure_time,stop_id,stop_sequence,drop_off_only,pickup_only" +
-                   " FROM gtfs_stop_times ORDER BY trip_id, stop_sequence;")
-    logging.debug("Starting iteration")
-    for row in progress(cursor):
-        yield row[0], StopTime(parse_timestamp(row[1]), parse_timestamp(row[2]), row[3], row[4], row[5], row[6])
-    logging.debug("Done iteration. Closing db connection.")
-    connection.close()
-    logging.debug("DB connection closed.")
+    try:
+        total_records = estimated_records()
+        logging.debug("There are about %d records in gtfs_stop_times table" % total_records)
+        logging.debug("Starting copy")
+        yield from progress(parse_copy_stop_times(copy_lines(connection, STOP_TIMES_COPY_QUERY)))
+        logging.debug("Done copy. Closing db connection.")
+    finally:
+        connection.close()
+        logging.debug("DB connection closed.")
 
 
 def group_by_trip_id(sequence):
@@ -215,7 +395,11 @@ def group_by_trip_id(sequence):
 
     if len(trip_stop_times) > 0:
         trips_count += 1
-        yield prev_trip_id, trip_stop_times
+        if trip_stop_times[0].stop_sequence == 1 and trip_stop_times[-1].stop_sequence == len(trip_stop_times):
+            yield prev_trip_id, trip_stop_times
+        else:
+            logging.error("Bad sequence for trip %s: %s" % (prev_trip_id, trip_stop_times))
+            bad_trips_count += 1
 
     logging.debug("Total number of trips in raw data: %d" % trips_count)
     logging.debug("Number of bad trips: %d" % bad_trips_count)
@@ -225,30 +409,214 @@ def build_route_stories(trip_and_stop_times):
     """ Builds route stories. Returns a dictionary from id to RouteStory object, and a dictionary
     from trip to a tuple, (route_story_id, start_time)"""
     logging.info("Building route stories")
-    route_story_to_id = {}  # Dict[int, RouteStory]
+    route_stories = {}  # Dict[int, RouteStory]
     trip_to_route_story = {}  # Dict[int, Tuple[int, datetime]]
+    # the route stories are deduplicated by a fingerprint of their packed encoding (see route_story_key); the
+    # encodings are only compared when the fingerprints match, and RouteStoryStop objects are only created for new
+    # route stories
+    fingerprint_to_ids = {}  # Dict[bytes, List[int]]
+    route_story_keys = {}  # Dict[int, bytes]
     for trip_id, stop_times in trip_and_stop_times:
         # get the start time in seconds since the start of the day
         start_time = stop_times[0].arrival_time
-        # convert the StopTime object to RouteStoryStop object; use a tuple because it's hashable
-        route_story_tuple = tuple(RouteStoryStop(stop_time.arrival_time - start_time,
-                                                 stop_time.departure_time - start_time,
-                                                 stop_time.stop_id,
-                                                 stop_time.stop_sequence,
-                                                 stop_time.pickup_type,
-                                                 stop_time.drop_off_type) for stop_time in stop_times)
-        # is it a new route story? if yes, allocate an id
-        if route_story_tuple not in route_story_to_id:
-            route_story_id = len(route_story_to_id) + 1
-            route_story_to_id[route_story_tuple] = route_story_id
-        trip_to_route_story[trip_id] = (route_story_to_id[route_story_tuple], start_time)
-
-    route_stories = {route_story_id: RouteStory(route_story_id, route_story_tuple)
-                     for route_story_tuple, route_story_id in route_story_to_id.items()}
+        key = route_story_key(stop_times, start_time)
+        candidates = fingerprint_to_ids.setdefault(hashlib.sha1(key).digest(), [])
+        for route_story_id in candidates:
+            if route_story_keys[route_story_id] == key:
+                break
+        else:
+            # a new route story, allocate an id
+            route_story_id = len(route_stories) + 1
+            candidates.append(route_story_id)
+            route_story_keys[route_story_id] = key
+            route_stories[route_story_id] = RouteStory(route_story_id, tuple(
+                RouteStoryStop(stop_time.arrival_time - start_time,
+                               stop_time.departure_time - start_time,
+                               stop_time.stop_id,
+                               stop_time.stop_sequence,
+                               stop_time.pickup_type,
+                               stop_time.drop_off_type) for stop_time in stop_times))
+        trip_to_route_story[trip_id] = (route_story_id, start_time)
+
     logging.info("%d route stories built" % len(route_stories))
     return route_stories, trip_to_route_story
 
 
+def route_story_key(stop_times, start_time):
+    """Encodes the route story of a trip with pack_route_story_stops"""
+    return pack_route_story_stops((stop_time.arrival_time - start_time,
+                                   stop_time.departure_time - start_time,
+                                   stop_time.stop_id,
+                                   stop_time.pickup_type,
+                                   stop_time.drop_off_type) for stop_time in stop_times)
+
+
+def pack_route_story_stops(stops):
+    """
+    Encodes a route story as packed int32 values. stops is a sequence of (arrival_offset, departure_offset, stop_id,
+    pickup_type, drop_off_type) tuples; pickup_type and drop_off_type are stored as integers, or -1 if they are
+    empty, so the encoding is the same whether the stop times were read from a file (strings) or from the db.
+    """
+    values = array('i')
+    for arrival_offset, departure_offset, stop_id, pickup_type, drop_off_type in stops:
+        values.extend((arrival_offset, departure_offset, stop_id,
+                       int(pickup_type) if pickup_type not in ('', None) else -1,
+                       int(drop_off_type) if drop_off_type not in ('', None) else -1))
+    return values.tobytes()
+
+
+class RouteStoryRegistry:
+    """
+    Keeps route story ids stable across feeds.
+
+    The registry is a csv file of (route_story_id, fingerprint) records, with every route story ever built. Route
+    stories whose fingerprint (see RouteStory.fingerprint) is in the registry get their old id, and new route stories
+    get new ids, larger than all the ids in the registry.
+    """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.fingerprint_to_id = {}
+        if os.path.exists(file_name):
+            with open(file_name, encoding='utf8') as f:
+                for record in csv.DictReader(f):
+                    self.fingerprint_to_id[record['fingerprint']] = int(record['route_story_id'])
+        self.next_id = max(self.fingerprint_to_id.values(), default=0) + 1
+        self.new_ids = set()
+
+    def id_for(self, fingerprint):
+        if fingerprint not in self.fingerprint_to_id:
+            self.fingerprint_to_id[fingerprint] = self.next_id
+            self.new_ids.add(self.next_id)
+            self.next_id += 1
+        return self.fingerprint_to_id[fingerprint]
+
+    def save(self):
+        tmp_file_name = '%s.tmp%d' % (self.file_name, os.getpid())
+        with open(tmp_file_name, 'w', encoding='utf8') as f:
+            writer = csv.writer(f, lineterminator='\n')
+            writer.writerow(['route_story_id', 'fingerprint'])
+            for fingerprint, route_story_id in sorted(self.fingerprint_to_id.items(), key=lambda item: item[1]):
+                writer.writerow([route_story_id, fingerprint])
+        os.replace(tmp_file_name, self.file_name)
+
+
+def apply_registry(route_stories, trip_to_route_story, registry):
+    """
+    Replaces the route story ids in the result of build_route_stories() with the ids from a RouteStoryRegistry. New
+    route stories are added to the registry in the order of their current ids, so the new ids are deterministic.
+    Returns a new (route_stories, trip_to_route_story) tuple.
+    """
+    new_ids = {route_story_id: registry.id_for(route_story.fingerprint())
+               for route_story_id, route_story in route_stories.items()}
+    logging.info("%d route stories are new to the registry" % len(set(new_ids.values()) & registry.new_ids))
+    return ({new_ids[route_story_id]: RouteStory(new_ids[route_story_id], route_story.stops)
+             for route_story_id, route_story in route_stories.items()},
+            {trip_id: (new_ids[route_story_id], start_time)
+             for trip_id, (route_story_id, start_time) in trip_to_route_story.items()})
+
+
+def sharded_build_route_stories(stop_times_file, processes, max_records_in_memory=None):
+    """
+    Builds route stories from a stop_times.txt file in parallel. Returns the same result as
+    build_route_stories(group_by_trip_id(stop_times_file_generator(stop_times_file))), including the route story ids.
+
+    The trips are partitioned to shards by a hash of their trip_id: first the file is split to chunks, and every chunk
+    is split to one temporary file per shard by a different process. Then every shard is sorted and has its route
+    stories built by a different process. Finally, identical route stories of different shards are unified, and the
+    ids are assigned in the order of the first trip (by trip_id) of each route story, like the serial build does.
+    """
+    header, ranges = split_csv_file(stop_times_file, processes)
+    shards = processes
+    logging.info("Building route stories in %d shards" % shards)
+    with tempfile.TemporaryDirectory() as tmp_folder, concurrent.futures.ProcessPoolExecutor(processes) as executor:
+        futures = [executor.submit(partition_stop_times_chunk, stop_times_file, header, start, end, shards,
+                                   os.path.join(tmp_folder, 'chunk%d' % i))
+                   for i, (start, end) in enumerate(ranges)]
+        chunk_files = [f.result() for f in futures]
+        logging.debug("Stop times partitioned to shards")
+        futures = [executor.submit(build_shard_route_stories, [files[shard] for files in chunk_files], header,
+                                   max_records_in_memory)
+                   for shard in range(shards)]
+        shard_results = [f.result() for f in futures]
+    route_stories, trip_to_route_story = merge_shard_route_stories(shard_results)
+    logging.info("%d route stories built" % len(route_stories))
+    return route_stories, trip_to_route_story
+
+
+def partition_stop_times_chunk(stop_times_file, header, start, end, shards, prefix):
+    """
+    Writes the lines in the byte range [start, end) of the file to one file per shard, by the hash of the trip_id.
+    Returns the list of shard file names.
+    """
+    trip_col = header.index('trip_id')
+    shard_lines = [[] for _ in range(shards)]
+    with open(stop_times_file, 'rb') as f:
+        f.seek(start)
+        for line in f.read(end - start).splitlines(keepends=True):
+            shard_lines[zlib.crc32(line.split(b',', trip_col + 1)[trip_col]) % shards].append(line)
+    file_names = []
+    for shard, lines in enumerate(shard_lines):
+        file_names.append('%s.shard%d' % (prefix, shard))
+        with open(file_names[-1], 'wb') as f:
+            f.writelines(lines)
+    return file_names
+
+
+def build_shard_route_stories(file_names, header, max_records_in_memory=None):
+    """
+    Builds the route stories of the stop times in the given shard files. Returns a tuple (stories, trips): stories is
+    a list of route stories in order of their first trip, each a tuple of (arrival_offset, departure_offset, stop_id,
+    stop_sequence, pickup_type, drop_off_type) tuples, and trips is a list of (trip_id, story index, start_time) tuples
+    sorted by trip_id.
+    """
+    key = stop_times_line_key(header)
+
+    def lines():
+        for file_name in file_names:
+            with open(file_name, encoding='utf8') as f:
+                yield from f
+
+    sorted_records = ((key(line)[0], StopTime.from_line(line))
+                      for line in external_sort(lines(), key, max_records_in_memory))
+    route_stories, trip_to_route_story = build_route_stories(group_by_trip_id(sorted_records))
+    stories = [tuple((stop.arrival_offset, stop.departure_offset, stop.stop_id, stop.stop_sequence, stop.pickup_type,
+                      stop.drop_off_type) for stop in route_story.stops)
+               for route_story in route_stories.values()]
+    trips = [(trip_id, route_story_id - 1, start_time)
+             for trip_id, (route_story_id, start_time) in trip_to_route_story.items()]
+    return stories, trips
+
+
+def merge_shard_route_stories(shard_results):
+    """Merges the results of build_shard_route_stories(). Returns the same result as build_route_stories()."""
+    # the first trip of every distinct route story, over all the shards
+    first_trip = {}
+    for stories, trips in shard_results:
+        seen = set()
+        for trip_id, story_index, _ in trips:
+            if story_index not in seen:
+                seen.add(story_index)
+                story = tuple(RouteStoryStop(*stop) for stop in stories[story_index])
+                if story not in first_trip or trip_id < first_trip[story]:
+                    first_trip[story] = trip_id
+
+    route_story_to_id = {story: route_story_id + 1 for route_story_id, story in
+                         enumerate(sorted(first_trip, key=lambda story: first_trip[story]))}
+    shard_story_ids = [[route_story_to_id[tuple(RouteStoryStop(*stop) for stop in story)] for story in stories]
+                       for stories, _ in shard_results]
+
+    trip_to_route_story = {}
+    shard_trips = [[(trip_id, shard, story_index, start_time) for trip_id, story_index, start_time in trips]
+                   for shard, (_, trips) in enumerate(shard_results)]
+    for trip_id, shard, story_index, start_time in heapq.merge(*shard_trips):
+        trip_to_route_story[trip_id] = (shard_story_ids[shard][story_index], start_time)
+
+    route_stories = {route_story_id: RouteStory(route_story_id, story)
+                     for story, route_story_id in route_story_to_id.items()}
+    return route_stories, trip_to_route_story
+
+
 def export_route_stories_to_csv(output_file, route_stories):
     logging.info("Exporting route story stops")
     with open(output_file, 'w') as f:
@@ -305,6 +673,254 @@ def load_route_stories_from_csv(route_stories_file, trip_to_route_story_file):
     return route_stories, trip_to_route_story
 
 
+def build_stop_patterns(route_stories):
+    """
+    Builds the stop patterns of the route stories: the distinct sequences of stop ids, regardless of the timing.
+    Returns a dictionary from stop_pattern_id to a tuple of stop ids, and a dictionary from route_story_id to
+    stop_pattern_id. The patterns are numbered in the order of the smallest route story id having them.
+    """
+    pattern_to_id = {}
+    route_story_to_pattern = {}
+    for route_story_id in sorted(route_stories):
+        pattern = tuple(stop.stop_id for stop in route_stories[route_story_id].stops)
+        route_story_to_pattern[route_story_id] = pattern_to_id.setdefault(pattern, len(pattern_to_id) + 1)
+    logging.info("%d stop patterns for %d route stories" % (len(pattern_to_id), len(route_story_to_pattern)))
+    return {pattern_id: pattern for pattern, pattern_id in pattern_to_id.items()}, route_story_to_pattern
+
+
+def export_stop_patterns_to_csv(patterns_file, route_story_patterns_file, patterns, route_story_to_pattern):
+    logging.info("Exporting stop patterns")
+    with open(patterns_file, 'w') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(['stop_pattern_id', 'stop_sequence', 'stop_id'])
+        for pattern_id, stop_ids in patterns.items():
+            writer.writerows((pattern_id, i + 1, stop_id) for i, stop_id in enumerate(stop_ids))
+    with open(route_story_patterns_file, 'w') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(['route_story_id', 'stop_pattern_id'])
+        writer.writerows(route_story_to_pattern.items())
+    logging.info("Stop patterns export done")
+
+
+def load_stop_patterns_from_csv(patterns_file, route_story_patterns_file):
+    """Reads stop patterns as written by export_stop_patterns_to_csv. Returns the same tuple as build_stop_patterns"""
+    pattern_stops = defaultdict(lambda: [])
+    with open(patterns_file, encoding='utf8') as f:
+        for record in csv.DictReader(f):
+            pattern_stops[int(record['stop_pattern_id'])].append((int(record['stop_sequence']), int(record['stop_id'])))
+    patterns = {pattern_id: tuple(stop_id for _, stop_id in sorted(stops)) for pattern_id, stops in
+                pattern_stops.items()}
+    with open(route_story_patterns_file, encoding='utf8') as f:
+        route_story_to_pattern = {int(record['route_story_id']): int(record['stop_pattern_id'])
+                                  for record in csv.DictReader(f)}
+    return patterns, route_story_to_pattern
+
+
+def load_stop_patterns(folder):
+    """Reads the stop patterns in folder (as written by main), or builds them from the route stories in folder if
+    they weren't exported"""
+    patterns_file = os.path.join(folder, 'stop_patterns.txt')
+    if os.path.exists(patterns_file):
+        return load_stop_patterns_from_csv(patterns_file, os.path.join(folder, 'route_story_patterns.txt'))
+    route_stories, _ = load_route_stories(folder)
+    return build_stop_patterns(route_stories)
+
+
+def stop_pattern_index(patterns):
+    """Returns a dictionary from stop_id to a list of (stop_pattern_id, stop_sequence) tuples of the patterns calling
+    at the stop"""
+    index = defaultdict(lambda: [])
+    for pattern_id, stop_ids in patterns.items():
+        for i, stop_id in enumerate(stop_ids):
+            index[stop_id].append((pattern_id, i + 1))
+    return dict(index)
+
+
+BINARY_FOLDER_NAME = 'route_stories_bin'
+
+
+def export_route_stories_to_binary(output_folder, route_stories, trip_to_route_story):
+    """
+    Writes the route stories and the trip to route story mapping in a binary format, that can be loaded much faster
+    than the csv files with load_route_stories_from_binary(). The output_folder will contain:
+
+    route_story_ids.npy: int32 array of the route story ids, sorted
+    stop_offsets.npy: int64 array; the stops of route_story_ids[i] are stops[stop_offsets[i]:stop_offsets[i + 1]]
+    stops.npy: int32 array with a row per stop: arrival_offset, departure_offset, stop_id, pickup_type, drop_off_type
+    trip_ids.txt: the trip ids, one per line
+    trip_start_times.npy, trip_route_story_ids.npy: int32 arrays with the start time and route story id of every trip
+    """
+    logging.info("Exporting route stories to %s" % output_folder)
+    os.makedirs(output_folder, exist_ok=True)
+
+    def as_int(value):
+        return int(value) if value != '' and value is not None else 0
+
+    route_story_ids = sorted(route_stories)
+    stop_offsets = np.zeros(len(route_story_ids) + 1, dtype=np.int64)
+    np.cumsum([len(route_stories[route_story_id].stops) for route_story_id in route_story_ids], out=stop_offsets[1:])
+    stops = np.array([(stop.arrival_offset, stop.departure_offset, stop.stop_id, as_int(stop.pickup_type),
+                       as_int(stop.drop_off_type))
+                      for route_story_id in route_story_ids for stop in route_stories[route_story_id].stops],
+                     dtype=np.int32).reshape(-1, 5)
+    np.save(os.path.join(output_folder, 'route_story_ids.npy'), np.array(route_story_ids, dtype=np.int32))
+    np.save(os.path.join(output_folder, 'stop_offsets.npy'), stop_offsets)
+    np.save(os.path.join(output_folder, 'stops.npy'), stops)
+
+    with open(os.path.join(output_folder, 'trip_ids.txt'), 'w', encoding='utf8') as f:
+        f.write('\n'.join(trip_to_route_story))
+    np.save(os.path.join(output_folder, 'trip_start_times.npy'),
+            np.array([start_time for _, start_time in trip_to_route_story.values()], dtype=np.int32))
+    np.save(os.path.join(output_folder, 'trip_route_story_ids.npy'),
+            np.array([route_story_id for route_story_id, _ in trip_to_route_story.values()], dtype=np.int32))
+    logging.info("Binary export done")
+
+
+class BinaryRouteStories(Mapping):
+    """
+    A read only dictionary from route_story_id to RouteStory, backed by the memory-mapped arrays written by
+    export_route_stories_to_binary(). RouteStory objects are created when they are first accessed.
+    """
+
+    def __init__(self, folder):
+        self.route_story_ids = np.load(os.path.join(folder, 'route_story_ids.npy'), mmap_mode='r')
+        self.stop_offsets = np.load(os.path.join(folder, 'stop_offsets.npy'), mmap_mode='r')
+        self.stops = np.load(os.path.join(folder, 'stops.npy'), mmap_mode='r')
+        self.route_stories = {}
+
+    def __getitem__(self, route_story_id):
+        if route_story_id not in self.route_stories:
+            i = int(np.searchsorted(self.route_story_ids, route_story_id))
+            if i == len(self.route_story_ids) or self.route_story_ids[i] != route_story_id:
+                raise KeyError(route_story_id)
+            rows = self.stops[self.stop_offsets[i]:self.stop_offsets[i + 1]].tolist()
+            stops = tuple(RouteStoryStop(arrival_offset, departure_offset, stop_id, stop_sequence + 1, pickup_type,
+                                         drop_off_type)
+                          for stop_sequence, (arrival_offset, departure_offset, stop_id, pickup_type, drop_off_type)
+                          in enumerate(rows))
+            self.route_stories[route_story_id] = RouteStory(route_story_id, stops)
+        return self.route_stories[route_story_id]
+
+    def __iter__(self):
+        return iter(self.route_story_ids.tolist())
+
+    def __len__(self):
+        return len(self.route_story_ids)
+
+
+class BinaryTripRouteStories(Mapping):
+    """
+    A read only dictionary from trip_id to TripRouteStory, backed by the memory-mapped arrays written by
+    export_route_stories_to_binary().
+    """
+
+    def __init__(self, folder, route_stories):
+        with open(os.path.join(folder, 'trip_ids.txt'), encoding='utf8') as f:
+            content = f.read()
+        self.trip_ids = content.split('\n') if content != '' else []
+        self.trip_index = {trip_id: i for i, trip_id in enumerate(self.trip_ids)}
+        self.start_times = np.load(os.path.join(folder, 'trip_start_times.npy'), mmap_mode='r')
+        self.route_story_ids = np.load(os.path.join(folder, 'trip_route_story_ids.npy'), mmap_mode='r')
+        self.route_stories = route_stories
+
+    def __getitem__(self, trip_id):
+        i = self.trip_index[trip_id]
+        return TripRouteStory(int(self.start_times[i]), self.route_stories[int(self.route_story_ids[i])])
+
+    def __contains__(self, trip_id):
+        return trip_id in self.trip_index
+
+    def __iter__(self):
+        return iter(self.trip_ids)
+
+    def __len__(self):
+        return len(self.trip_ids)
+
+
+def load_route_stories_from_binary(folder):
+    """Reads route stories as written by export_route_stories_to_binary. Returns the same tuple as
+    load_route_stories_from_csv, but the dictionaries are read only, and are populated lazily."""
+    route_stories = BinaryRouteStories(folder)
+    return route_stories, BinaryTripRouteStories(folder, route_stories)
+
+
+def load_route_stories(folder):
+    """Reads the route stories in folder (as written by main), from the binary format if it's there, and from the
+    csv files otherwise"""
+    binary_folder = os.path.join(folder, BINARY_FOLDER_NAME)
+    if os.path.exists(binary_folder):
+        return load_route_stories_from_binary(binary_folder)
+    return load_route_stories_from_csv(os.path.join(folder, 'route_stories.txt'),
+                                       os.path.join(folder, 'trip_to_stories.txt'))
+
+
+class StopRouteStoryIndex:
+    """
+    An inverted index from stop_id to the route stories calling at the stop.
+
+    stop_ids is a sorted array of the stop ids; the calls at stop_ids[i] are calls[offsets[i]:offsets[i + 1]], where
+    every row of calls is (route_story_id, stop_sequence, arrival_offset), sorted by route_story_id and stop_sequence.
+    """
+
+    def __init__(self, stop_ids, offsets, calls):
+        self.stop_ids = stop_ids
+        self.offsets = offsets
+        self.calls = calls
+
+    @classmethod
+    def from_route_stories(cls, route_stories):
+        """Builds the index from a dictionary from route_story_id to RouteStory"""
+        rows = [(stop.stop_id, route_story_id, stop_sequence + 1, stop.arrival_offset)
+                for route_story_id in sorted(route_stories)
+                for stop_sequence, stop in enumerate(route_stories[route_story_id].stops)]
+        rows = np.array(rows, dtype=np.int32).reshape(-1, 4)
+        rows = rows[np.argsort(rows[:, 0], kind='stable')]
+        stop_ids, counts = np.unique(rows[:, 0], return_counts=True)
+        offsets = np.zeros(len(stop_ids) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        return cls(stop_ids, offsets, np.ascontiguousarray(rows[:, 1:]))
+
+    def save(self, folder):
+        os.makedirs(folder, exist_ok=True)
+        np.save(os.path.join(folder, 'stop_index_stop_ids.npy'), self.stop_ids)
+        np.save(os.path.join(folder, 'stop_index_offsets.npy'), self.offsets)
+        np.save(os.path.join(folder, 'stop_index_calls.npy'), self.calls)
+
+    @classmethod
+    def load(cls, folder):
+        """Loads an index written by save(). The arrays are memory-mapped."""
+        return cls(*(np.load(os.path.join(folder, 'stop_index_%s.npy' % name), mmap_mode='r')
+                     for name in ('stop_ids', 'offsets', 'calls')))
+
+    @classmethod
+    def exists(cls, folder):
+        return os.path.exists(os.path.join(folder, 'stop_index_calls.npy'))
+
+    def calls_at(self, stop_id):
+        """Returns a list of StopCall tuples, for all the route stories calling at stop_id"""
+        i = int(np.searchsorted(self.stop_ids, stop_id))
+        if i == len(self.stop_ids) or self.stop_ids[i] != stop_id:
+            return []
+        return [StopCall(*call) for call in self.calls[self.offsets[i]:self.offsets[i + 1]].tolist()]
+
+    def route_story_ids_at(self, stop_ids):
+        """Returns the set of ids of the route stories calling at any of the stops"""
+        return {call.route_story_id for stop_id in stop_ids for call in self.calls_at(stop_id)}
+
+
+def load_stop_route_story_index(folder, route_stories=None):
+    """
+    Returns the StopRouteStoryIndex of the route stories in folder (as written by main). If it wasn't exported, it's
+    built from route_stories, or from the route stories in folder if route_stories isn't given.
+    """
+    binary_folder = os.path.join(folder, BINARY_FOLDER_NAME)
+    if StopRouteStoryIndex.exists(binary_folder):
+        return StopRouteStoryIndex.load(binary_folder)
+    if route_stories is None:
+        route_stories, _ = load_route_stories(folder)
+    return StopRouteStoryIndex.from_route_stories(route_stories)
+
+
 def main():
     logging.basicConfig(level=logging.DEBUG,
                         format='%(asctime)s %(message)s',
@@ -313,18 +929,34 @@ def main():
     if config["source"] == "file":
         logging.info("Loading data from file", config["source"])
         source_file_name = config["source_file_name"]
-        source_data = stop_times_file_generator(source_file_name)
+        processes = int(config["processes"]) if config.get("processes") else None
+        max_records_in_memory = int(config["max_records_in_memory"]) if config.get("max_records_in_memory") else None
+        presorted = config.get("presorted", "false").lower() == "true"
+        if processes is not None:
+            stories, trips = sharded_build_route_stories(source_file_name, processes, max_records_in_memory)
+        else:
+            source_data = stop_times_file_generator(source_file_name, None, max_records_in_memory, presorted)
+            stories, trips = build_route_stories(group_by_trip_id(source_data))
     elif config["source"] == "db":
         logging.info("Loading data from db")
-        source_data = stop_times_db_generator(config)
+        stories, trips = build_route_stories(group_by_trip_id(stop_times_db_generator(config)))
     else:
         raise Exception("Unknown source type %s" % config["source"])
 
-    stories, trips = build_route_stories(group_by_trip_id(source_data))
+    if config.get("registry_file"):
+        registry = RouteStoryRegistry(config["registry_file"])
+        stories, trips = apply_registry(stories, trips, registry)
+        registry.save()
 
     output_folder = config["output_folder"]
     export_route_stories_to_csv(os.path.join(output_folder, 'route_stories.txt'), stories)
     export_trip_route_stories_to_csv(os.path.join(output_folder, 'trip_to_stories.txt'), trips)
+    export_route_stories_to_binary(os.path.join(output_folder, BINARY_FOLDER_NAME), stories, trips)
+    StopRouteStoryIndex.from_route_stories(stories).save(os.path.join(output_folder, BINARY_FOLDER_NAME))
+    patterns, route_story_to_pattern = build_stop_patterns(stories)
+    export_stop_patterns_to_csv(os.path.join(output_folder, 'stop_patterns.txt'),
+                                os.path.join(output_folder, 'route_story_patterns.txt'), patterns,
+                                route_story_to_pattern)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,96 @@
+"""
+A precomputed index of the dates on which each service (calendar record) and trip is active.
+
+Trip.active_on_date checks the date range and the days of the week of the trip's service on every call. Analytics that
+ask "which trips run on date D" or "how many times does each trip run between A and B" for every trip in the feed should
+use ServiceCalendar instead, where the first question is a single lookup, and the second is computed for all the trips
+at once with NumPy.
+"""
+import datetime
+
+import numpy as np
+
+
+class ServiceCalendar:
+    """
+    active[d, s] is True if the service with index s (see service_ids) is active on start_date + d days.
+    trip_service[t] is the index of the service of the trip with index t (see trip_ids).
+    """
+
+    def __init__(self, services, trips):
+        """
+        :param services: dictionary from service_id to Service object (GTFS.services)
+        :param trips: dictionary from trip_id to Trip object (GTFS.trips)
+        """
+        self.service_ids = list(services)
+        service_index = {service_id: i for i, service_id in enumerate(self.service_ids)}
+        self.trip_ids = list(trips)
+        self.trip_index = {trip_id: i for i, trip_id in enumerate(self.trip_ids)}
+        self.trip_service = np.array([service_index[trip.service.service_id] for trip in trips.values()],
+                                     dtype=np.int32)
+
+        if len(services) > 0:
+            self.start_date = min(service.start_date for service in services.values())
+            self.end_date = max(service.end_date for service in services.values())
+            days = (self.end_date - self.start_date).days + 1
+        else:
+            # e.g. a feed filter that drops all the services; the calendar has no days
+            self.start_date = self.end_date = None
+            days = 0
+        weekdays = (self.start_date.weekday() + np.arange(days)) % 7 if days > 0 else np.zeros(0, dtype=np.int64)
+        self.active = np.zeros((days, len(self.service_ids)), dtype=bool)
+        for i, service in enumerate(services.values()):
+            first = (service.start_date - self.start_date).days
+            last = (service.end_date - self.start_date).days + 1
+            self.active[first:last, i] = np.isin(weekdays[first:last], list(service.days))
+
+        # active trip indexes, computed when a date is first requested
+        self._active_trips = {}
+
+    def day_index(self, on_date):
+        """Returns the row of on_date in self.active, or None if it's outside the calendar"""
+        if len(self.active) == 0 or not self.start_date <= on_date <= self.end_date:
+            return None
+        return (on_date - self.start_date).days
+
+    def dates(self):
+        return [self.start_date + datetime.timedelta(days=d) for d in range(len(self.active))]
+
+    def active_service_ids(self, on_date):
+        d = self.day_index(on_date)
+        if d is None:
+            return []
+        return [self.service_ids[i] for i in np.flatnonzero(self.active[d])]
+
+    def active_trip_indexes(self, on_date):
+        """Returns an array of the indexes (into self.trip_ids) of the trips active on on_date"""
+        d = self.day_index(on_date)
+        if d is None:
+            return np.zeros(0, dtype=np.int64)
+        if d not in self._active_trips:
+            self._active_trips[d] = np.flatnonzero(self.active[d, self.trip_service])
+        return self._active_trips[d]
+
+    def active_trip_ids(self, on_date):
+        return [self.trip_ids[i] for i in self.active_trip_indexes(on_date)]
+
+    def is_active(self, trip_id, on_date):
+        d = self.day_index(on_date)
+        return d is not None and bool(self.active[d, self.trip_service[self.trip_index[trip_id]]])
+
+    def trip_run_counts(self, start_date, end_date, weekdays=None):
+        """
+        Returns an array with the number of days each trip runs between start_date and end_date (inclusive).
+        If weekdays (a set of date.weekday() values) is given, only these days of the week are counted.
+        """
+        if len(self.active) == 0:
+            return np.zeros(len(self.trip_ids), dtype=np.int64)
+        first = max((start_date - self.start_date).days, 0)
+        last = min((end_date - self.start_date).days + 1, len(self.active))
+        if first >= last:
+            return np.zeros(len(self.trip_ids), dtype=np.int64)
+        active = self.active[first:last]
+        if weekdays is not None:
+            date_weekdays = (self.start_date.weekday() + np.arange(first, last)) % 7
+            active = active[np.isin(date_weekdays, list(weekdays))]
+        return active.sum(axis=0)[self.trip_service]
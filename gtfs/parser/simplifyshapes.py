@@ -88,7 +88,7 @@ def main():
     args = parse_flags()
     g = GTFS(args.gtfs_file_name)
     g.load_shapes()
-    simplified = {shape.shape_id: ramer_douglas_peucker(list(shape.coordinates.values()), args.epsilon) for shape in g.shapes.values()}
+    simplified = {shape.shape_id: ramer_douglas_peucker(shape.points, args.epsilon) for shape in g.shapes.values()}
     export_shapes(args.output_file_name, simplified)
 
 if __name__ == '__main__':
@@ -0,0 +1,129 @@
+"""
+Checks the staging schema load of ps_insert (see insert_folder_to_db) against the tables of gtfs/schema.sql.
+
+The check creates a scratch database, <db_name>_swap_check, so the db user needs the CREATEDB privilege. It creates the
+tables of gtfs/schema.sql there, loads a GTFS file with staging_schema set twice (the second load replaces tables that
+already hold a feed), and checks that the live tables hold the feed, with their indexes and serial sequences, and that
+the staging schema is gone. The scratch database is dropped at the end.
+
+    python3 -m gtfs.parser.staging_swap_check <your configuration file name>
+"""
+import csv
+import io
+import os
+import re
+import sys
+import tempfile
+import zipfile
+from argparse import ArgumentParser
+
+from jinja2 import Environment, FileSystemLoader
+
+from gtfs.parser import ps_insert
+
+SCHEMA_FILE = os.path.join(ps_insert.GTFS_SCRIPT_DIR, 'schema.sql')
+SAMPLE_FEED = os.path.join(ps_insert.parent_dir(ps_insert.GTFS_SCRIPT_DIR), 'data', 'sample',
+                           'israel-public-transportation.zip')
+
+
+def connect(db_config):
+    env = Environment(loader=FileSystemLoader(ps_insert.TEMPLATES_PATH))
+    conn_template = env.get_template(ps_insert.CONNECTION_TEMPLATE_FILE_NAME)
+    return ps_insert.connect(ps_insert.build_connection_string(db_config, conn_template))
+
+
+def create_schema(conn_obj):
+    """Creates the tables of gtfs/schema.sql. The role and owner statements are skipped, the obus role may not exist."""
+    with open(SCHEMA_FILE) as f:
+        schema = f.read()
+    schema = re.sub(r'SET ROLE \w+;', '', schema)
+    schema = re.sub(r'ALTER TABLE \w+\s+OWNER TO \w+;', '', schema)
+    conn_obj.cursor().execute(schema)
+    conn_obj.commit()
+
+
+def feed_counts(gtfs_file_name):
+    """Returns a dictionary from table name to the number of records in the feed"""
+    counts = {}
+    with zipfile.ZipFile(gtfs_file_name) as z:
+        for name in z.namelist():
+            with z.open(name) as f:
+                counts[ps_insert.get_table_name(name)] = sum(1 for _ in csv.reader(io.TextIOWrapper(f, 'utf-8-sig'))) - 1
+    return counts
+
+
+def table_state(cursor):
+    """Returns the (table name, index name) pairs of the gtfs tables in public"""
+    cursor.execute("SELECT tablename, indexname FROM pg_indexes WHERE schemaname = 'public' AND tablename LIKE 'gtfs_%' "
+                   "ORDER BY tablename, indexname")
+    return cursor.fetchall()
+
+
+def check_load(conn_obj, staging_schema, counts, indexes):
+    """Returns a list of the problems found after a load"""
+    cursor = conn_obj.cursor()
+    problems = []
+    cursor.execute("SELECT count(*) FROM pg_namespace WHERE nspname = %s", (staging_schema,))
+    if cursor.fetchone()[0] != 0:
+        problems.append("schema %s wasn't dropped" % staging_schema)
+    for table_name, count in sorted(counts.items()):
+        cursor.execute("SELECT count(*) FROM public.%s" % table_name)
+        loaded = cursor.fetchone()[0]
+        if loaded != count:
+            problems.append("%s has %d rows instead of %d" % (table_name, loaded, count))
+    if table_state(cursor) != indexes:
+        problems.append("the indexes changed: %s instead of %s" % (table_state(cursor), indexes))
+    cursor.execute("SELECT pg_get_serial_sequence('public.gtfs_stop_times', 'id')")
+    sequence = cursor.fetchone()[0]
+    if sequence is None:
+        problems.append("gtfs_stop_times.id has no serial sequence")
+    else:
+        cursor.execute("SELECT nextval(%s) > (SELECT max(id) FROM public.gtfs_stop_times)", (sequence,))
+        if not cursor.fetchone()[0]:
+            problems.append("the next value of %s is already used" % sequence)
+    conn_obj.rollback()
+    return problems
+
+
+def main():
+    parser = ArgumentParser(description='Checks the staging schema load of ps_insert in a scratch database')
+    parser.add_argument('config_file_name')
+    parser.add_argument('--gtfs_file_name', default=SAMPLE_FEED)
+    args = parser.parse_args()
+    db_config = ps_insert.parse_config(args.config_file_name)
+    check_config = dict(db_config, db_name=db_config['db_name'] + '_swap_check', mode='copy', processes='',
+                        staging_schema=db_config.get('staging_schema') or 'gtfs_staging')
+
+    admin_conn = connect(db_config)
+    admin_conn.autocommit = True
+    admin_conn.cursor().execute("DROP DATABASE IF EXISTS %s" % check_config['db_name'])
+    admin_conn.cursor().execute("CREATE DATABASE %s" % check_config['db_name'])
+    problems = []
+    conn_obj = None
+    try:
+        conn_obj = connect(check_config)
+        create_schema(conn_obj)
+        indexes = table_state(conn_obj.cursor())
+        conn_obj.commit()
+        counts = feed_counts(args.gtfs_file_name)
+        with tempfile.TemporaryDirectory() as rejects_folder:
+            check_config['rejects_folder'] = rejects_folder
+            for load in range(1, 3):
+                print("Load %d" % load)
+                ps_insert.insert_folder_to_db(args.gtfs_file_name, check_config)
+                problems.extend("load %d: %s" % (load, problem)
+                                for problem in check_load(conn_obj, check_config['staging_schema'], counts, indexes))
+    finally:
+        if conn_obj is not None:
+            conn_obj.close()
+        admin_conn.cursor().execute("DROP DATABASE IF EXISTS %s" % check_config['db_name'])
+        admin_conn.close()
+
+    for problem in problems:
+        print(problem)
+    print("Staging swap check %s" % ('failed' if len(problems) > 0 else 'passed'))
+    sys.exit(1 if len(problems) > 0 else 0)
+
+
+if __name__ == '__main__':
+    main()
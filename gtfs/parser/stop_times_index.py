@@ -0,0 +1,125 @@
+"""
+A random access index into stop_times.txt.
+
+Reading the stop times of a single trip from the zip file means decompressing and parsing the whole stop_times table.
+StopTimesIndex is built once per feed, with one pass over an uncompressed copy of stop_times.txt (see
+feed_cache.extract_member), and records the byte ranges of the records of every trip. Both the copy and the index are
+kept in the cache folder next to the zip file, so later lookups only seek to the trip's ranges and parse these lines.
+
+The index is stored as two files: trip_ids.txt, with the trip_id of every range, one per line, and ranges.bin, with the
+(offset, length) pairs of the ranges as 64 bit integers. Usually there's one range per trip, but records of a trip that
+aren't consecutive in the file get a range each.
+"""
+import csv
+import os
+import sys
+from array import array
+from argparse import ArgumentParser
+
+from gtfs.parser import feed_cache
+
+INDEX_FORMAT_VERSION = 1
+
+
+class StopTimesIndex:
+    def __init__(self, path, header, ranges):
+        """
+        :param path: path of the uncompressed stop_times.txt
+        :param header: list of column names
+        :param ranges: dictionary from trip_id to a list of (offset, length) tuples
+        """
+        self.path = path
+        self.header = header
+        self.ranges = ranges
+
+    @classmethod
+    def for_feed(cls, filename):
+        """Returns the index of the GTFS zip file, building it on the first call"""
+        path = feed_cache.extract_member(filename, 'stop_times.txt')
+        folder = feed_cache.entry_folder(filename, 'stop_times_index', INDEX_FORMAT_VERSION)
+        if not os.path.exists(folder):
+            print("Indexing %s" % path)
+            tmp_folder = '%s.tmp%d' % (folder, os.getpid())
+            os.makedirs(tmp_folder)
+            cls.build(path).save(tmp_folder)
+            feed_cache.replace_entry(tmp_folder, folder)
+            feed_cache.remove_stale_entries(filename, 'stop_times_index', INDEX_FORMAT_VERSION)
+        return cls.load(path, folder)
+
+    @classmethod
+    def build(cls, path):
+        """Indexes the file with one pass over its lines"""
+        ranges = {}
+        with open(path, 'rb') as f:
+            header = next(csv.reader([f.readline().decode('utf-8-sig')]))
+            trip_col = header.index('trip_id')
+            offset = f.tell()
+            current_trip_id, start = None, offset
+            for line in f:
+                trip_id = line.split(b',', trip_col + 1)[trip_col].decode('utf8')
+                if trip_id != current_trip_id:
+                    if current_trip_id is not None:
+                        ranges.setdefault(current_trip_id, []).append((start, offset - start))
+                    current_trip_id, start = trip_id, offset
+                offset += len(line)
+            if current_trip_id is not None:
+                ranges.setdefault(current_trip_id, []).append((start, offset - start))
+        return cls(path, header, ranges)
+
+    def save(self, folder):
+        with open(os.path.join(folder, 'header.txt'), 'w', encoding='utf8') as f:
+            f.write(','.join(self.header))
+        trip_ids, offsets = [], array('q')
+        for trip_id, trip_ranges in self.ranges.items():
+            for offset, length in trip_ranges:
+                trip_ids.append(trip_id)
+                offsets.extend((offset, length))
+        with open(os.path.join(folder, 'trip_ids.txt'), 'w', encoding='utf8') as f:
+            f.write('\n'.join(trip_ids))
+        with open(os.path.join(folder, 'ranges.bin'), 'wb') as f:
+            offsets.tofile(f)
+
+    @classmethod
+    def load(cls, path, folder):
+        with open(os.path.join(folder, 'header.txt'), encoding='utf8') as f:
+            header = f.read().split(',')
+        with open(os.path.join(folder, 'trip_ids.txt'), encoding='utf8') as f:
+            content = f.read()
+        trip_ids = content.split('\n') if content != '' else []
+        offsets = array('q')
+        with open(os.path.join(folder, 'ranges.bin'), 'rb') as f:
+            offsets.frombytes(f.read())
+        ranges = {}
+        for i, trip_id in enumerate(trip_ids):
+            ranges.setdefault(trip_id, []).append((offsets[2 * i], offsets[2 * i + 1]))
+        return cls(path, header, ranges)
+
+    def __contains__(self, trip_id):
+        return trip_id in self.ranges
+
+    def __len__(self):
+        return len(self.ranges)
+
+    def records(self, trip_id):
+        """Returns the records of the trip as dictionaries from column name to value, in file order"""
+        lines = []
+        with open(self.path, 'rb') as f:
+            for offset, length in self.ranges.get(trip_id, []):
+                f.seek(offset)
+                lines.extend(f.read(length).decode('utf8').splitlines())
+        return [dict(zip(self.header, row)) for row in csv.reader(lines)]
+
+
+def main():
+    parser = ArgumentParser(description='Prints the stop_times records of a trip')
+    parser.add_argument('--gtfs_file_name', required=True)
+    parser.add_argument('--trip_id', required=True)
+    args = parser.parse_args()
+    index = StopTimesIndex.for_feed(args.gtfs_file_name)
+    writer = csv.DictWriter(sys.stdout, fieldnames=index.header, lineterminator='\n')
+    writer.writeheader()
+    writer.writerows(sorted(index.records(args.trip_id), key=lambda record: int(record['stop_sequence'])))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+"""
+Expanding route stories to the actual stop events on given dates.
+
+A route story and a start time describe a single trip, and the service calendar tells on which dates each trip runs.
+Questions like "which trains call at station X on date D, and when" need these combined to stop events: (date, trip,
+stop, arrival time). Timetable computes the events of all the active trips of a date at once, with NumPy, and returns
+them as arrays (a StopEvents tuple). Use iter_events() to go over a date range one date at a time, or events() to get
+all the events of the range in one set of arrays.
+"""
+import datetime
+from collections import namedtuple
+
+import numpy as np
+
+from gtfs.parser.route_stories import BinaryRouteStories, BinaryTripRouteStories
+
+# Every field is an array with an element per event. trip is an index into ServiceCalendar.trip_ids; arrival_time and
+# departure_time are in seconds since the start of the date (so they can be more than 24 hours).
+StopEvents = namedtuple('StopEvents', 'date trip stop_id stop_sequence arrival_time departure_time pickup_type '
+                                      'drop_off_type')
+
+
+class Timetable:
+    def __init__(self, calendar, route_stories, trip_to_route_story):
+        """
+        :param calendar: a ServiceCalendar (GTFS.service_calendar)
+        :param route_stories: dictionary from route_story_id to RouteStory, as returned by load_route_stories()
+        :param trip_to_route_story: dictionary from trip_id to TripRouteStory, as returned by load_route_stories()
+        """
+        self.calendar = calendar
+        self.load_route_stories(route_stories)
+        self.load_trips(trip_to_route_story)
+
+    def load_route_stories(self, route_stories):
+        """Keeps all the route story stops in arrays, with the stops of story i in offsets[i]:offsets[i + 1]"""
+        if isinstance(route_stories, BinaryRouteStories):
+            self.route_story_ids = np.asarray(route_stories.route_story_ids)
+            self.offsets = np.asarray(route_stories.stop_offsets)
+            stops = np.asarray(route_stories.stops)
+        else:
+            self.route_story_ids = np.array(sorted(route_stories), dtype=np.int32)
+            self.offsets = np.zeros(len(self.route_story_ids) + 1, dtype=np.int64)
+            np.cumsum([len(route_stories[i].stops) for i in self.route_story_ids.tolist()], out=self.offsets[1:])
+            stops = np.array([(stop.arrival_offset, stop.departure_offset, stop.stop_id, stop.pickup_type or 0,
+                               stop.drop_off_type or 0)
+                              for i in self.route_story_ids.tolist() for stop in route_stories[i].stops],
+                             dtype=np.int32).reshape(-1, 5)
+        self.arrival_offset, self.departure_offset, self.stop_id, self.pickup_type, self.drop_off_type = \
+            (np.ascontiguousarray(stops[:, column]) for column in range(5))
+        self.counts = np.diff(self.offsets)
+
+    def load_trips(self, trip_to_route_story):
+        """
+        Keeps the route story (as an index into self.route_story_ids) and start time of every trip of the calendar.
+        Trips without a route story get -1. Raises ValueError if a trip refers to a route story that isn't in
+        route_stories.
+        """
+        trip_ids = self.calendar.trip_ids
+        self.trip_story = np.full(len(trip_ids), -1, dtype=np.int64)
+        self.trip_start = np.zeros(len(trip_ids), dtype=np.int32)
+        if isinstance(trip_to_route_story, BinaryTripRouteStories):
+            calendar_index = np.array([self.calendar.trip_index.get(trip_id, -1)
+                                       for trip_id in trip_to_route_story.trip_ids], dtype=np.int64)
+            known = calendar_index >= 0
+            story_ids = np.asarray(trip_to_route_story.route_story_ids)[known]
+            start_times = np.asarray(trip_to_route_story.start_times)[known]
+            calendar_index = calendar_index[known]
+        else:
+            known = [(i, trip_to_route_story[trip_id]) for i, trip_id in enumerate(trip_ids)
+                     if trip_id in trip_to_route_story]
+            calendar_index = np.array([i for i, _ in known], dtype=np.int64)
+            story_ids = np.array([trip.route_story.route_story_id for _, trip in known], dtype=np.int32)
+            start_times = np.array([trip.start_time for _, trip in known], dtype=np.int32)
+        story_index = np.searchsorted(self.route_story_ids, story_ids)
+        # searchsorted returns the insertion point of missing ids, which is another story, or len(route_story_ids)
+        found = story_index < len(self.route_story_ids)
+        found[found] = self.route_story_ids[story_index[found]] == story_ids[found]
+        if not found.all():
+            missing = np.unique(story_ids[~found])
+            raise ValueError("%d trips refer to route stories that aren't loaded, e.g. %s" %
+                             ((~found).sum(), ', '.join(str(i) for i in missing[:5].tolist())))
+        self.trip_story[calendar_index] = story_index
+        self.trip_start[calendar_index] = start_times
+
+    def trip_mask(self, trip_ids):
+        """Returns a boolean array over the calendar trips, True for the given trip ids, to pass as trip_mask"""
+        mask = np.zeros(len(self.calendar.trip_ids), dtype=bool)
+        mask[[self.calendar.trip_index[trip_id] for trip_id in trip_ids if trip_id in self.calendar.trip_index]] = True
+        return mask
+
+    def day_events(self, on_date, trip_mask=None, stop_ids=None):
+        """
+        Returns the StopEvents of all the trips active on on_date, sorted by trip (in calendar order) and stop
+        sequence. If trip_mask (see trip_mask()) is given, only the events of these trips are returned; if stop_ids
+        (an array or a collection of stop ids) is given, only the events at these stops.
+        """
+        trips = self.calendar.active_trip_indexes(on_date)
+        trips = trips[self.trip_story[trips] >= 0]
+        if trip_mask is not None:
+            trips = trips[trip_mask[trips]]
+        stories = self.trip_story[trips]
+        counts = self.counts[stories]
+        total = int(counts.sum())
+        # position of each event in its route story: 0, 1, ..., counts[0] - 1, 0, 1, ..., counts[1] - 1, ...
+        within = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+        positions = np.repeat(self.offsets[stories], counts) + within
+        trip = np.repeat(trips, counts)
+        if stop_ids is not None:
+            keep = np.isin(self.stop_id[positions], np.asarray(list(stop_ids) if isinstance(stop_ids, (set, frozenset))
+                                                               else stop_ids))
+            positions, within, trip = positions[keep], within[keep], trip[keep]
+        start = self.trip_start[trip]
+        return StopEvents(np.full(len(trip), np.datetime64(on_date, 'D')),
+                          trip,
+                          self.stop_id[positions],
+                          (within + 1).astype(np.int32),
+                          start + self.arrival_offset[positions],
+                          start + self.departure_offset[positions],
+                          self.pickup_type[positions],
+                          self.drop_off_type[positions])
+
+    def iter_events(self, start_date, end_date, trip_mask=None, stop_ids=None):
+        """Yields (date, StopEvents) for every date from start_date to end_date (inclusive). See day_events()."""
+        on_date = start_date
+        while on_date <= end_date:
+            yield on_date, self.day_events(on_date, trip_mask, stop_ids)
+            on_date += datetime.timedelta(days=1)
+
+    def events(self, start_date, end_date, trip_mask=None, stop_ids=None):
+        """Returns the StopEvents of all the dates from start_date to end_date (inclusive), sorted by date"""
+        days = [events for _, events in self.iter_events(start_date, end_date, trip_mask, stop_ids)]
+        if len(days) == 0:
+            return self.day_events(start_date, np.zeros(len(self.calendar.trip_ids), dtype=bool))
+        return StopEvents(*(np.concatenate(column) for column in zip(*days)))
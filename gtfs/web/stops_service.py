@@ -1,5 +1,5 @@
 from gtfs.parser.gtfs_reader import GTFS
-from gtfs.parser.route_stories import load_route_stories_from_csv
+from gtfs.parser.route_stories import load_route_stories
 from gtfs.bus2train.utilities import load_train_station_distance, routes_calling_at_stop, route_frequency
 from collections import defaultdict
 
@@ -13,8 +13,12 @@ import json
 from datetime import date
 import sys
 
-gtfs_folder = 'data/gtfs/gtfs_2016_05_25/' if len(sys.argv) == 1 else sys.argv[1]
+# usage: stops_service.py [gtfs folder] [--snapshot]
+# --snapshot keeps a binary snapshot of the parsed gtfs next to the zip file, so restarting the service is fast
+folder_args = [arg for arg in sys.argv[1:] if arg != '--snapshot']
+gtfs_folder = 'data/gtfs/gtfs_2016_05_25/' if len(folder_args) == 0 else folder_args[0]
 start_date = date(2016, 6, 1)
+use_gtfs_snapshot = '--snapshot' in sys.argv[1:]
 
 
 class IndexServer:
@@ -29,7 +33,7 @@ class IndexServer:
 
 class StopFinder:
     def __init__(self, gtfs_folder):
-        self.gtfs = GTFS(os.path.join(gtfs_folder, 'israel-public-transportation.zip'))
+        self.gtfs = GTFS(os.path.join(gtfs_folder, 'israel-public-transportation.zip'), snapshot=use_gtfs_snapshot)
         self.gtfs.load_stops()
         self.gtfs.load_routes()
 
@@ -44,9 +48,7 @@ class StopFinder:
         print("Station distance loaded")
 
         print("Loading route stories")
-        route_stories, trip_to_stories = load_route_stories_from_csv(os.path.join(gtfs_folder, 'route_stories.txt'),
-                                                                     os.path.join(gtfs_folder,
-                                                                                  'trip_to_stories.txt'))
+        route_stories, trip_to_stories = load_route_stories(gtfs_folder)
         print("Route stories loaded")
 
         print("Loading routes calling at stops")
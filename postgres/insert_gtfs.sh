@@ -7,11 +7,6 @@ fi
 
 export PGPASSWORD=$3
 
-mkdir -p /tmp/gtfs
-
-time unzip -o -d /tmp/gtfs $1
-
-cut -d',' -f1,2 /tmp/gtfs/agency.txt  > /tmp/gtfs/agency_for_db.txt
-
-time psql -h 127.0.0.1 -U $2 obus < insert_gtfs.sql
+# the files are streamed from the zip file to the db, nothing is extracted
+time sed "s|GTFS_ZIP|$1|g" insert_gtfs.sql | psql -h 127.0.0.1 -U $2 obus
 
@@ -1,15 +1,17 @@
 -- run timing to see how much time everything takes
 \timing
 
+-- stop on the first error, so a failed load doesn't replace the old tables
+\set ON_ERROR_STOP on
 
--- drop old tables
-DROP TABLE IF EXISTS gtfs_agency;
-DROP TABLE IF EXISTS gtfs_routes;
-DROP TABLE IF EXISTS gtfs_trips;
-DROP TABLE IF EXISTS gtfs_calendar;
-DROP TABLE IF EXISTS gtfs_stop_times;
-DROP TABLE IF EXISTS gtfs_stops;
-DROP TABLE IF EXISTS gtfs_shapes;
+-- the files are decompressed from the GTFS zip file straight to \copy; insert_gtfs.sh replaces GTFS_ZIP with its path
+
+
+-- the new tables are created and loaded in the gtfs_staging schema, while queries keep reading the old tables in
+-- public. When they are all loaded and indexed, they replace the old tables in one transaction (see the end of the file)
+DROP SCHEMA IF EXISTS gtfs_staging CASCADE;
+CREATE SCHEMA gtfs_staging;
+SET search_path TO gtfs_staging;
 
 ---- agencies ----
 \echo ********** importing agencies **********
@@ -23,7 +25,7 @@ CREATE TABLE gtfs_agency
 ALTER TABLE gtfs_agency
   OWNER TO obus;
 
-\copy gtfs_agency from '/tmp/gtfs/agency_for_db.txt' DELIMITER ',' CSV HEADER;
+\copy gtfs_agency from program 'unzip -p "GTFS_ZIP" agency.txt | cut -d, -f1,2' DELIMITER ',' CSV HEADER;
 
 
 -- routes --
@@ -45,7 +47,7 @@ ALTER TABLE gtfs_routes
 
 
 
-\copy gtfs_routes from '/tmp/gtfs/routes.txt' DELIMITER ',' CSV HEADER;
+\copy gtfs_routes from program 'unzip -p "GTFS_ZIP" routes.txt' DELIMITER ',' CSV HEADER;
 
 
 ALTER TABLE gtfs_routes
@@ -79,7 +81,7 @@ CREATE TABLE gtfs_stops
 ALTER TABLE gtfs_stops
   OWNER TO obus;
 
-\copy gtfs_stops(stop_id, stop_code, stop_name, stop_desc, stop_lat, stop_lon, location_type, parent_station, zone_id) from '/tmp/gtfs/stops.txt' DELIMITER ',' CSV HEADER;
+\copy gtfs_stops(stop_id, stop_code, stop_name, stop_desc, stop_lat, stop_lon, location_type, parent_station, zone_id) from program 'unzip -p "GTFS_ZIP" stops.txt' DELIMITER ',' CSV HEADER;
 
 UPDATE gtfs_stops
 SET address = left(trim(split_part(stop_desc, ':', 2)), -4),
@@ -125,7 +127,7 @@ CREATE TABLE gtfs_trips
 ALTER TABLE gtfs_trips
   OWNER TO obus;
 
-\copy gtfs_trips from '/tmp/gtfs/trips.txt' DELIMITER ',' CSV HEADER;
+\copy gtfs_trips from program 'unzip -p "GTFS_ZIP" trips.txt' DELIMITER ',' CSV HEADER;
 
 
 ALTER TABLE gtfs_trips
@@ -165,7 +167,7 @@ CREATE TABLE gtfs_calendar
 ALTER TABLE gtfs_calendar
   OWNER TO obus;
 
-\copy gtfs_calendar from '/tmp/gtfs/calendar.txt' DELIMITER ',' CSV HEADER;
+\copy gtfs_calendar from program 'unzip -p "GTFS_ZIP" calendar.txt' DELIMITER ',' CSV HEADER;
 
 
 ALTER TABLE gtfs_calendar
@@ -193,7 +195,7 @@ CREATE TABLE gtfs_stop_times
 ALTER TABLE gtfs_stop_times
   OWNER TO obus;
 
-\copy gtfs_stop_times from '/tmp/gtfs/stop_times.txt' DELIMITER ',' CSV HEADER;
+\copy gtfs_stop_times from program 'unzip -p "GTFS_ZIP" stop_times.txt' DELIMITER ',' CSV HEADER;
 
 -- renamed the fields to something more self explanatory
 -- It's not a mistake! see GTFS documentation.
@@ -240,10 +242,40 @@ CREATE TABLE gtfs_shapes
 ALTER TABLE gtfs_shapes
   OWNER TO obus;
 
-\copy gtfs_shapes from '/tmp/gtfs/shapes.txt' DELIMITER ',' CSV HEADER;
+\copy gtfs_shapes from program 'unzip -p "GTFS_ZIP" shapes.txt' DELIMITER ',' CSV HEADER;
 
-ALTER TABLE shapes
+ALTER TABLE gtfs_shapes
   ADD CONSTRAINT shapes_pkey PRIMARY KEY (shape_id, shape_pt_sequence);
 
+ANALYZE gtfs_agency;
+ANALYZE gtfs_routes;
+ANALYZE gtfs_trips;
+ANALYZE gtfs_calendar;
+ANALYZE gtfs_stop_times;
+ANALYZE gtfs_stops;
+ANALYZE gtfs_shapes;
+
+-- replace the old tables
+\echo ********** replacing the old tables **********
+BEGIN;
+DROP TABLE IF EXISTS public.gtfs_agency;
+ALTER TABLE gtfs_staging.gtfs_agency SET SCHEMA public;
+DROP TABLE IF EXISTS public.gtfs_routes;
+ALTER TABLE gtfs_staging.gtfs_routes SET SCHEMA public;
+DROP TABLE IF EXISTS public.gtfs_trips;
+ALTER TABLE gtfs_staging.gtfs_trips SET SCHEMA public;
+DROP TABLE IF EXISTS public.gtfs_calendar;
+ALTER TABLE gtfs_staging.gtfs_calendar SET SCHEMA public;
+DROP TABLE IF EXISTS public.gtfs_stop_times;
+ALTER TABLE gtfs_staging.gtfs_stop_times SET SCHEMA public;
+DROP TABLE IF EXISTS public.gtfs_stops;
+ALTER TABLE gtfs_staging.gtfs_stops SET SCHEMA public;
+DROP TABLE IF EXISTS public.gtfs_shapes;
+ALTER TABLE gtfs_staging.gtfs_shapes SET SCHEMA public;
+COMMIT;
+
+DROP SCHEMA gtfs_staging;
+SET search_path TO public;
+
 -- make sure re:dash can access the new tables
 GRANT SELECT ON ALL TABLES IN SCHEMA public TO redash;
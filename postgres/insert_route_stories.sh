@@ -3,6 +3,8 @@
 # Script for adding route stories data to gtfs in postgres
 # Runs route story generation, and then adds the results to the db
 # The script assumes the gtfs is already in database, probably inserted using insert_gtfs.sh
+# Route story ids are kept in a registry file (ROUTE_STORY_REGISTRY, by default ~/route_story_registry.txt), so
+# only new route stories are inserted. If the registry doesn't exist yet, the route story tables are recreated.
 
 if [ "$#" -ne 2 ]; then
     echo "Usage: $0 db_username db_password"
@@ -19,16 +21,24 @@ echo "db_name = obus" >> $CONFIG_FILE_NAME
 echo "db_user = $1" >> $CONFIG_FILE_NAME
 echo "db_password = $2" >> $CONFIG_FILE_NAME
 echo "output_folder = /tmp/gtfs" >> $CONFIG_FILE_NAME
+REGISTRY_FILE=${ROUTE_STORY_REGISTRY:-$HOME/route_story_registry.txt}
+echo "registry_file = $REGISTRY_FILE" >> $CONFIG_FILE_NAME
 echo >>  $CONFIG_FILE_NAME
 
 
+export PGPASSWORD=$2
+
+# ids in the db tables are meaningless without the registry they were assigned from
+if [ ! -f "$REGISTRY_FILE" ]; then
+    echo "No route story registry at $REGISTRY_FILE, recreating route story tables"
+    psql -h 127.0.0.1 -U $1 obus -c "DROP TABLE IF EXISTS route_story_stops; DROP TABLE IF EXISTS trip_route_story;"
+fi
+
 # Run route stories generation
 python3 -m gtfs.parser.route_stories $CONFIG_FILE_NAME
 
-export PGPASSWORD=$2
-
 # run route story insert
-time psql -h 127.0.0.1 -U $2 obus < ./postgres/insert_route_stories.sql
+time psql -h 127.0.0.1 -U $1 obus < ./postgres/insert_route_stories.sql
 
 
 
@@ -2,14 +2,14 @@
 \timing
 
 
--- drop old tables
-DROP TABLE IF EXISTS route_story_stops;
+-- route story ids are kept stable across feeds by the route story registry (see make_route_stories.config.example),
+-- so only new route stories are inserted. The trips change with every feed, so trip_route_story is reloaded.
 DROP TABLE IF EXISTS trip_route_story;
 
 \echo ********** importing route story stops **********
 
 
-CREATE TABLE route_story_stops
+CREATE TABLE IF NOT EXISTS route_story_stops
 (
   route_story_id      INTEGER,
   arrival_offset        INTEGER,
@@ -20,13 +20,18 @@ CREATE TABLE route_story_stops
   drop_off_type       BOOLEAN
 );
 
+CREATE TEMPORARY TABLE new_route_story_stops (LIKE route_story_stops);
 
-\copy route_story_stops from '/tmp/gtfs/route_stories.txt' DELIMITER ',' CSV HEADER;
+\copy new_route_story_stops from '/tmp/gtfs/route_stories.txt' DELIMITER ',' CSV HEADER;
 
-CREATE INDEX route_story_stops_route_story_id
+INSERT INTO route_story_stops
+  SELECT n.* FROM new_route_story_stops n
+  WHERE NOT EXISTS (SELECT 1 FROM route_story_stops r WHERE r.route_story_id = n.route_story_id);
+
+CREATE INDEX IF NOT EXISTS route_story_stops_route_story_id
   ON route_story_stops USING BTREE (route_story_id);
 
-CREATE INDEX route_story_stops_stop_id
+CREATE INDEX IF NOT EXISTS route_story_stops_stop_id
   ON route_story_stops USING BTREE (stop_id);
 
 
@@ -43,8 +48,42 @@ CREATE TABLE trip_route_story
 ALTER TABLE trip_route_story
   ADD CONSTRAINT trip_id_pkey PRIMARY KEY (trip_id);
 
+
+\echo ********** importing stop patterns **********
+-- stop pattern ids are numbered on every run, so the pattern tables are reloaded
+DROP TABLE IF EXISTS stop_pattern_stops;
+DROP TABLE IF EXISTS route_story_stop_pattern;
+
+CREATE TABLE stop_pattern_stops
+(
+  stop_pattern_id     INTEGER,
+  stop_sequence       INTEGER,
+  stop_id             INTEGER
+);
+
+\copy stop_pattern_stops from '/tmp/gtfs/stop_patterns.txt' DELIMITER ',' CSV HEADER;
+
+CREATE INDEX stop_pattern_stops_stop_pattern_id
+  ON stop_pattern_stops USING BTREE (stop_pattern_id);
+
+CREATE INDEX stop_pattern_stops_stop_id
+  ON stop_pattern_stops USING BTREE (stop_id);
+
+CREATE TABLE route_story_stop_pattern
+(
+  route_story_id      INTEGER,
+  stop_pattern_id     INTEGER
+);
+
+\copy route_story_stop_pattern from '/tmp/gtfs/route_story_patterns.txt' DELIMITER ',' CSV HEADER;
+
+ALTER TABLE route_story_stop_pattern
+  ADD CONSTRAINT route_story_stop_pattern_pkey PRIMARY KEY (route_story_id);
+
 ALTER TABLE route_story_stops OWNER TO obus;
 ALTER TABLE trip_route_story OWNER TO obus;
+ALTER TABLE stop_pattern_stops OWNER TO obus;
+ALTER TABLE route_story_stop_pattern OWNER TO obus;
 
 -- make sure re:dash can access the new tables
 GRANT SELECT ON ALL TABLES IN SCHEMA public TO redash;
\ No newline at end of file